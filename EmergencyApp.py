@@ -1,4 +1,10 @@
 import csv
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import geocoder
 from kivy.app import App
 from kivy.uix.screenmanager import ScreenManager, Screen
@@ -13,49 +19,117 @@ from kivy.core.window import Window
 from kivy.uix.floatlayout import FloatLayout
 from kivy.graphics import Color, RoundedRectangle
 
+from coordinate_log import coordinate_log
+from emergency_registry import registry as emergency_registry
+from message_bus import (BUS_PORTS, CsvCompatAdapter, EmergencyRegistration, MessageBus, PositionUpdate,
+                         SocketBridge, emergency_registration, position_update)
+
 # Set window size for better visualization (Optional)
 Window.size = (400, 600)
 
-# Function to check if the driver ID exists in emergency.csv
+# Positions and emergency registrations are published on the message bus: check.py and the
+# signal controller receive them directly, and the CSV adapter keeps the shared files current
+bus = MessageBus()
+CsvCompatAdapter(bus, write_positions=False)  # Positions are written in batches by the PositionPipeline
+bus_bridge = SocketBridge(bus, peers=BUS_PORTS.values(), forward_types=(PositionUpdate, EmergencyRegistration))
+
+# Function to check if the driver ID exists in emergency.csv (served from the cached registry)
 def check_driver_id(driver_id):
-    try:
-        with open('emergency.csv', mode='r') as file:
-            reader = csv.reader(file)
-            for row in reader:
-                if row and driver_id == row[1]:  # Check if driver_id matches the ID in the 2nd column
-                    return True
-    except FileNotFoundError:
-        print("emergency.csv not found.")
-    return False
-
-# Function to append coordinates to coordinates.csv
+    return emergency_registry.contains(driver_id)
+
+# Approximate distance in meters between two (lat, lon) points; accurate enough for thresholds
+def distance_m(a, b):
+    mean_lat = math.radians((a[0] + b[0]) / 2)
+    dx = math.radians(b[1] - a[1]) * math.cos(mean_lat)
+    dy = math.radians(b[0] - a[0])
+    return 6371000 * math.hypot(dx, dy)
+
+# Filters and batches position fixes before they are written and published.
+# A fix is dropped if the driver moved less than min_distance_m and less than max_interval
+# seconds passed since the last accepted fix. Accepted fixes are buffered and flushed together
+# once batch_size fixes or max_batch_age seconds accumulate (checked on every fix, dropped or not),
+# and immediately on the first fix, on a jump of flush_distance_m or more, or when the driver's
+# emergency level changes.
+# flush_distance_m stays well below the 1.5 km signal radius, so the proximity checker always
+# sees a driver within that distance of where they really are and never misses a zone entry.
+class PositionPipeline:
+    def __init__(self, sink, min_distance_m=25, max_interval=30, batch_size=5, max_batch_age=5,
+                 flush_distance_m=200, clock=time.time):
+        self.sink = sink
+        self.min_distance_m = min_distance_m
+        self.max_interval = max_interval
+        self.batch_size = batch_size
+        self.max_batch_age = max_batch_age
+        self.flush_distance_m = flush_distance_m
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.last_accepted = {}  # driver_id -> ((lat, lon), accepted_at)
+        self.last_flushed = {}  # driver_id -> (lat, lon) last handed to the sink
+        self.levels = {}  # driver_id -> last seen emergency level
+        self.pending = []  # (driver_id, (lat, lon), fixed_at) waiting for the next flush
+        self.pending_since = None
+        self.metrics = {'received': 0, 'dropped': 0, 'flushes': 0, 'written': 0}
+
+    def submit(self, driver_id, coordinates, level=None):
+        now = self.clock()
+        with self.lock:
+            self.metrics['received'] += 1
+            # Age out the buffer first, so a parked vehicle whose fixes are all dropped still gets written
+            if self.pending_since is not None and now - self.pending_since >= self.max_batch_age:
+                self.flush_locked()
+            if not isinstance(coordinates, tuple):
+                self.metrics['dropped'] += 1  # "Location not available"
+                return
+
+            level_changed = driver_id in self.levels and level != self.levels[driver_id]
+            self.levels[driver_id] = level
+            last = self.last_accepted.get(driver_id)
+            if (last is not None and not level_changed and distance_m(last[0], coordinates) < self.min_distance_m
+                    and now - last[1] < self.max_interval):
+                self.metrics['dropped'] += 1
+                return
+
+            self.last_accepted[driver_id] = (coordinates, now)
+            self.pending.append((driver_id, coordinates, now))
+            if self.pending_since is None:
+                self.pending_since = now
+
+            flushed_from = self.last_flushed.get(driver_id)
+            if (flushed_from is None or level_changed
+                    or distance_m(flushed_from, coordinates) >= self.flush_distance_m
+                    or len(self.pending) >= self.batch_size or now - self.pending_since >= self.max_batch_age):
+                self.flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if not self.pending:
+            return
+        batch, self.pending, self.pending_since = self.pending, [], None
+        for driver_id, coordinates, _ in batch:
+            self.last_flushed[driver_id] = coordinates
+        self.metrics['flushes'] += 1
+        self.metrics['written'] += len(batch)
+        self.sink(batch)
+
+# Write a batch of fixes to coordinates.csv in one append and publish them on the bus,
+# stamped with their fix time so the proximity checker can estimate speed from them
+def store_position_batch(batch):
+    coordinate_log.append_many([(driver_id, coordinates) for driver_id, coordinates, _ in batch])
+    for driver_id, (lat, lon), fixed_at in batch:
+        bus.publish(position_update(driver_id, lat, lon, fixed_at))
+
+position_pipeline = PositionPipeline(store_position_batch)
+
+# Function to append coordinates to coordinates.csv (filtered and batched by the position pipeline)
 def update_coordinates_in_csv(driver_id, live_coordinates):
-    data = []
-    try:
-        with open('coordinates.csv', mode='r') as file:
-            reader = csv.reader(file)
-            data = list(reader)
-    except FileNotFoundError:
-        pass  # If file does not exist, we'll create it later
-
-    # Update or add the driver's coordinates
-    updated = False
-    with open('coordinates.csv', mode='w', newline='') as file:
-        writer = csv.writer(file)
-        for row in data:
-            if row and row[0] == driver_id:
-                writer.writerow([driver_id, live_coordinates])  # Update coordinates for existing driver
-                updated = True
-            else:
-                writer.writerow(row)
-        if not updated:
-            writer.writerow([driver_id, live_coordinates])  # Add new entry for new driver
+    position_pipeline.submit(driver_id, live_coordinates, emergency_registry.level_of(driver_id))
 
 # Function to write emergency form data to a CSV file
 def write_emergency_to_csv(emergency_level, driver_id):
-    with open('emergency.csv', mode='a', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow([emergency_level, driver_id])
+    bus.publish(emergency_registration(emergency_level, driver_id))
 
 # Function to get real GPS coordinates
 def get_live_coordinates():
@@ -66,6 +140,47 @@ def get_live_coordinates():
     
     return lat, lon
 
+# Location provider used for tracking: any callable returning (lat, lon) or "Location not available".
+# Set TRAFFIC_REPLAY_TRACK to replay a recorded track through a FakeLocationProvider instead.
+location_provider = get_live_coordinates
+
+# Fake location provider that replays a fixed list of positions, repeating the last one.
+# With `times` (one per position) its time() follows the replayed fixes, for PositionPipeline's clock.
+class FakeLocationProvider:
+    def __init__(self, positions, times=None):
+        self.positions = list(positions)
+        self.times = None if times is None else list(times)
+        self.index = 0
+
+    def __call__(self):
+        position = self.positions[min(self.index, len(self.positions) - 1)]
+        self.index += 1
+        return position
+
+    # Recorded time of the position returned last (wall time if there are no recorded times)
+    def time(self):
+        if not self.times:
+            return time.time()
+        return self.times[min(max(self.index - 1, 0), len(self.times) - 1)]
+
+# Load a recorded track (rows of t,lat,lon) as a FakeLocationProvider
+def load_replay_track(path):
+    times, positions = [], []
+    with open(path, mode='r') as file:
+        for row in csv.reader(file):
+            if len(row) >= 3:
+                times.append(float(row[0]))
+                positions.append((float(row[1]), float(row[2])))
+    return FakeLocationProvider(positions, times)
+
+# Replay a recorded drive without network lookups (TRAFFIC_REPLAY_TRACK=<csv of t,lat,lon>). The
+# position pipeline then runs on the recorded fix times, so its filtering and batching behave as
+# they did on the road whatever the tracking interval.
+REPLAY_TRACK = os.environ.get('TRAFFIC_REPLAY_TRACK')
+if REPLAY_TRACK:
+    location_provider = load_replay_track(REPLAY_TRACK)
+    position_pipeline.clock = location_provider.time
+
 class MainScreen(Screen):
     def __init__(self, **kwargs):
         super(MainScreen, self).__init__(**kwargs)
@@ -123,13 +238,60 @@ class DriverLoginScreen(Screen):
             self.show_invalid_popup()  # Show error if invalid
 
     def start_tracking(self, driver_id):
-        Clock.schedule_interval(lambda dt: self.update_location(driver_id), 1)
+        # Pressing Connect again replaces the running timer instead of stacking another one
+        if getattr(self, 'tracking_event', None) is not None:
+            self.tracking_event.cancel()
+        if getattr(self, 'location_worker', None) is None:
+            self.location_worker = ThreadPoolExecutor(max_workers=1)
+            self.location_in_flight = threading.Event()
+        self.tracking_event = Clock.schedule_interval(lambda dt: self.update_location(driver_id), 1)
         print("Driver ID valid. Tracking started...")
 
+    # Stop the timer and write out the fixes still buffered in the position pipeline. The flush
+    # runs on the location worker, after any lookup in flight; wait=True also shuts the worker down.
+    def stop_tracking(self, wait=False):
+        if getattr(self, 'tracking_event', None) is not None:
+            self.tracking_event.cancel()
+            self.tracking_event = None
+        if getattr(self, 'location_worker', None) is not None:
+            self.location_worker.submit(self.flush_positions)
+            if wait:
+                self.location_worker.shutdown(wait=True)
+                self.location_worker = None
+
+    # Runs on the worker thread
+    def flush_positions(self):
+        try:
+            position_pipeline.flush()
+        except Exception as error:
+            print(f"Storing buffered locations failed: {error}")
+
+    # Runs on the UI thread every second: hand the slow lookup and write to the background worker
     def update_location(self, driver_id):
-        live_coordinates = get_live_coordinates()  # Get real GPS coordinates
+        if self.location_in_flight.is_set():
+            return  # Previous lookup still running; skip this tick rather than queueing up
+        self.location_in_flight.set()
+        self.location_worker.submit(self.fetch_and_store_location, driver_id)
+
+    # Runs on the worker thread
+    def fetch_and_store_location(self, driver_id):
+        try:
+            try:
+                live_coordinates = location_provider()  # Get real GPS coordinates
+            except Exception as error:  # geocoder raises or returns no latlng when offline
+                print(f"Location lookup failed: {error}")
+                live_coordinates = "Location not available"
+            try:
+                update_coordinates_in_csv(driver_id, live_coordinates)  # Save coordinates to CSV
+            except Exception as error:  # e.g. OSError writing coordinates.csv
+                print(f"Storing location failed: {error}")
+        finally:
+            self.location_in_flight.clear()
+        Clock.schedule_once(lambda dt: self.on_location_updated(driver_id, live_coordinates))
+
+    # Back on the UI thread with the stored result
+    def on_location_updated(self, driver_id, live_coordinates):
         print(f"Updating coordinates for {driver_id}: {live_coordinates}")
-        update_coordinates_in_csv(driver_id, live_coordinates)  # Save coordinates to CSV
 
     def show_invalid_popup(self):
         popup = Popup(title='Error',
@@ -238,5 +400,8 @@ class LoginApp(App):
         sm.add_widget(HospitalLoginScreen(name='hospital'))
         return sm
 
+    def on_stop(self):
+        self.root.get_screen('driver').stop_tracking(wait=True)
+
 if __name__ == '__main__':
     LoginApp().run()
@@ -1,144 +1,1224 @@
-import csv
+import asyncio
+import heapq
+import inspect
+import itertools
+import json
+import multiprocessing
 import cv2
 import numpy as np
+import os
+import queue
+import threading
 import time
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
-weights_path = r"C:\\Users\\welcome\\Downloads\\yolov3.weights"
-cfg_path = r"C:\\Users\\welcome\\Downloads\\yolov3.cfg"
-coco_names_path = r"C:\\Users\\welcome\\Downloads\\coco.names.txt"
+from emergency_registry import ACTIVE_LEVELS, registry as emergency_registry
+from message_bus import BUS_PORTS, EmergencyRegistration, MessageBus, PreemptionRequest, SocketBridge
 
-net = cv2.dnn.readNet(weights_path, cfg_path)
-layer_names = net.getLayerNames()
-output_layers = [layer_names[i - 1] for i in net.getUnconnectedOutLayers()]
+# Networks an edge unit can choose from with TRAFFIC_MODEL. The tiny variants trade some accuracy
+# for several times less compute; a smaller input_size (e.g. 320) cuts the cost further. Only Darknet
+# .weights/.cfg pairs are supported: decode_detections reads Darknet region output, which ONNX
+# YOLO exports do not produce.
+MODELS = {
+    'yolov3': {'weights': r"C:\\Users\\welcome\\Downloads\\yolov3.weights",
+               'cfg': r"C:\\Users\\welcome\\Downloads\\yolov3.cfg", 'input_size': 416},
+    'yolov3-tiny': {'weights': r"C:\\Users\\welcome\\Downloads\\yolov3-tiny.weights",
+                    'cfg': r"C:\\Users\\welcome\\Downloads\\yolov3-tiny.cfg", 'input_size': 416},
+    'yolov4-tiny': {'weights': r"C:\\Users\\welcome\\Downloads\\yolov4-tiny.weights",
+                    'cfg': r"C:\\Users\\welcome\\Downloads\\yolov4-tiny.cfg", 'input_size': 416},
+}
+MODEL = os.environ.get('TRAFFIC_MODEL', 'yolov3')
+model_config = MODELS.get(MODEL, MODELS['yolov3'])  # An unknown MODEL is reported when the net loads
 
-try:
-    with open(coco_names_path, "r") as f:
-        classes = [line.strip() for line in f.readlines()]
-except IOError:
-    print(f"Error: Could not read class names from {coco_names_path}")
-    sys.exit()
+# Model paths; the TRAFFIC_* environment variables override the selected model's defaults
+weights_path = os.environ.get('TRAFFIC_WEIGHTS', model_config['weights'])
+cfg_path = os.environ.get('TRAFFIC_CFG', model_config['cfg'])
+coco_names_path = os.environ.get('TRAFFIC_NAMES', r"C:\\Users\\welcome\\Downloads\\coco.names.txt")
+INPUT_SIZE = int(os.environ.get('TRAFFIC_INPUT_SIZE', model_config['input_size']))
 
+# Run the net in half precision where OpenCV supports it (TRAFFIC_FP16=1)
+USE_FP16 = os.environ.get('TRAFFIC_FP16', '0') == '1'
 
-# Function to check for High/Medium priority in emergency.csv
+# 'yolo' loads the real network; 'stub' uses StubNetwork (simulation and benchmarks)
+DETECTOR = os.environ.get('TRAFFIC_DETECTOR', 'yolo')
+
+# Run one blank frame through the net right after loading it in the analysis workers, so the
+# first real frame does not pay for lazy allocations inside OpenCV (TRAFFIC_WARM_UP=0 to skip)
+WARM_UP_MODEL = os.environ.get('TRAFFIC_WARM_UP', '1') == '1'
+
+# Detection settings shared by the decode and NMS steps
+CONFIDENCE_THRESHOLD = 0.3
+NMS_THRESHOLD = 0.4
+VEHICLE_CLASSES = ['car', 'truck']
+
+
+# Stand-in for a cv2.dnn net: forward() returns YOLO-shaped outputs holding `vehicles`
+# well-separated car/truck detections per image, after an optional per-image delay (scaled by the
+# blob's area relative to a 416x416 input, like a real network's cost)
+class StubNetwork:
+    def __init__(self, classes, vehicles=5, latency=0.0):
+        self.classes = classes
+        self.vehicles = vehicles
+        self.latency = latency
+        self.batch = 1
+        self.area = 1.0
+
+    def getLayerNames(self):
+        return ['stub_output']
+
+    def getUnconnectedOutLayers(self):
+        return [1]
+
+    def setInput(self, blob):
+        self.batch = blob.shape[0]
+        self.area = blob.shape[2] * blob.shape[3] / (416 * 416)
+
+    def forward(self, layers):
+        if self.latency:
+            time.sleep(self.latency * self.batch * self.area)
+        vehicles = min(int(self.vehicles), 100)
+        out = np.zeros((max(vehicles, 1) * 3, 85), dtype=np.float32)
+        out[:, 2:4] = 0.05
+        for i in range(vehicles):
+            name = VEHICLE_CLASSES[i % len(VEHICLE_CLASSES)]
+            out[i, 0] = 0.05 + (i % 10) * 0.1  # 10x10 grid of non-overlapping boxes
+            out[i, 1] = 0.05 + (i // 10) * 0.1
+            out[i, 5 + self.classes.index(name)] = 0.9
+        if self.batch == 1:
+            return (out,)
+        return (np.stack([out] * self.batch),)
+
+
+# Lazily loaded detection model. Nothing is read from disk until the class names or the net are
+# first used, so importing this module (e.g. for countdown) stays cheap. Each process owns its
+# own net: one inherited over fork is reloaded on first use in the child.
+class Detector:
+    def __init__(self, weights=weights_path, cfg=cfg_path, names=coco_names_path, input_size=INPUT_SIZE,
+                 kind=DETECTOR, fp16=USE_FP16, model=MODEL):
+        self.model = model
+        self.weights = weights
+        self.cfg = cfg
+        self.names = names
+        self.input_size = input_size
+        self.kind = kind
+        self.fp16 = fp16
+        self.lock = threading.Lock()
+        self.network = None
+        self.output_layers = None
+        self.pid = None  # Process that loaded self.network
+        self.class_names = None
+        self.timings = {'load_seconds': None, 'warm_up_seconds': None, 'first_frame_seconds': None}
+
+    @property
+    def classes(self):
+        if self.class_names is None:
+            try:
+                with open(self.names, "r") as f:
+                    self.class_names = [line.strip() for line in f.readlines()]
+            except IOError as e:
+                raise IOError(f"Could not read class names from {self.names}: {e}") from e
+        return self.class_names
+
+    @property
+    def vehicle_class_ids(self):
+        return [self.classes.index(name) for name in VEHICLE_CLASSES if name in self.classes]
+
+    @property
+    def net(self):
+        return self.load().network
+
+    def load(self, warm_up=False):
+        with self.lock:
+            if self.pid == os.getpid():
+                return self
+            if self.kind != 'stub' and self.model not in MODELS:
+                raise ValueError(f"Unknown model {self.model!r} (TRAFFIC_MODEL), expected one of {list(MODELS)}")
+            start_time = time.perf_counter()
+            classes = self.classes  # Class names are read as part of startup
+            if self.kind == 'stub':
+                network = StubNetwork(classes)
+            else:
+                if not self.weights.lower().endswith('.weights'):
+                    raise ValueError(f"Expected Darknet .weights for the detection model, got {self.weights}")
+                network = cv2.dnn.readNet(self.weights, self.cfg)
+                if self.fp16 and hasattr(cv2.dnn, 'DNN_TARGET_CPU_FP16'):
+                    network.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU_FP16)
+            layer_names = network.getLayerNames()
+            self.output_layers = [layer_names[i - 1] for i in np.asarray(network.getUnconnectedOutLayers()).flatten()]
+            self.network = network
+            self.pid = os.getpid()
+            self.timings.update(load_seconds=time.perf_counter() - start_time, warm_up_seconds=None,
+                                first_frame_seconds=None)
+
+            if warm_up:
+                start_time = time.perf_counter()
+                network.setInput(self.blob([np.zeros((self.input_size, self.input_size, 3), dtype=np.uint8)]))
+                network.forward(self.output_layers)
+                self.timings['warm_up_seconds'] = time.perf_counter() - start_time
+        return self
+
+    # size is the (width, height) of the network input, by default input_size square
+    def blob(self, frames, size=None):
+        size = (self.input_size, self.input_size) if size is None else size
+        return cv2.dnn.blobFromImages(frames, 0.00392, size, (0, 0, 0), True, crop=False)
+
+    # One forward pass; the first one after loading is timed as the first-frame latency
+    def forward(self, blob):
+        network = self.net
+        start_time = time.perf_counter()
+        network.setInput(blob)
+        outs = network.forward(self.output_layers)
+        if self.timings['first_frame_seconds'] is None:
+            self.timings['first_frame_seconds'] = time.perf_counter() - start_time
+            self.check_outputs(outs)
+        return outs
+
+    # decode_detections expects Darknet region rows: normalized cx, cy, w, h, objectness, then
+    # one score per class. Fail on the first frame rather than silently counting nothing.
+    def check_outputs(self, outs):
+        widths = {out.shape[-1] for out in outs}
+        if widths != {5 + len(self.classes)}:
+            raise ValueError(f"Model {self.weights} returns rows of {sorted(widths)} values, expected Darknet "
+                             f"region output with {5 + len(self.classes)} (5 + {len(self.classes)} classes)")
+
+    def report(self):
+        name = 'stub' if self.kind == 'stub' else os.path.basename(self.weights)
+        if self.timings['load_seconds'] is None:
+            return f"Model {name} not loaded yet"
+        text = f"Model {name} ({self.input_size}px) loaded in {self.timings['load_seconds']:.2f} s"
+        if self.timings['warm_up_seconds'] is not None:
+            text += f", warm-up {self.timings['warm_up_seconds']:.2f} s"
+        if self.timings['first_frame_seconds'] is not None:
+            text += f", first frame {self.timings['first_frame_seconds']:.3f} s"
+        return text
+
+
+detector = Detector()
+
+# Headless mode skips all drawing and GUI calls (roadside units have no display)
+HEADLESS = os.environ.get('TRAFFIC_HEADLESS', '0') == '1'
+
+
+# Function to check for High/Medium priority in emergency.csv (served from the cached registry)
 def check_emergency_priority():
+    return emergency_registry.has_active_emergency()
+
+
+# Per-camera regions of interest: a JSON file mapping a video path (or its file name) to the lane
+# polygons of the queue at the stop line, as fractions of the frame width and height, e.g.
+#   {"cam1.mp4": {"lanes": [{"name": "left", "polygon": [[0.1, 0.5], [0.4, 0.5], [0.4, 1], [0, 1]]},
+#                           {"name": "right", "polygon": [[0.4, 0.5], [0.7, 0.5], [0.9, 1], [0.4, 1]]}]}}
+# Cameras without an entry are analysed on the full frame.
+ROI_CONFIG_PATH = os.environ.get('TRAFFIC_ROI', 'roi.json')
+
+
+# Lane polygons of one camera. Frames are cropped to the polygons' bounding box before inference,
+# and a detection belongs to the lane containing the bottom-centre of its box (where the vehicle
+# meets the road); detections in no lane are dropped.
+class CameraROI:
+    def __init__(self, lanes):
+        self.names = [name for name, _ in lanes]
+        self.polygons = [np.asarray(polygon, dtype=np.float32).reshape(-1, 2) for _, polygon in lanes]
+        points = np.concatenate(self.polygons)
+        self.low = np.clip(points.min(axis=0), 0, 1)
+        self.high = np.clip(points.max(axis=0), 0, 1)
+
+    # Pixel bounds (x0, y0, x1, y1) of the crop for a frame of the given size
+    def bounds(self, width, height):
+        x0, y0 = int(self.low[0] * width), int(self.low[1] * height)
+        x1, y1 = int(np.ceil(self.high[0] * width)), int(np.ceil(self.high[1] * height))
+        return x0, y0, max(x1, x0 + 1), max(y1, y0 + 1)
+
+    def crop(self, frame):
+        x0, y0, x1, y1 = self.bounds(frame.shape[1], frame.shape[0])
+        return frame[y0:y1, x0:x1]
+
+    # Network input (width, height) for the crop: the full-frame input_size scaled by the crop's
+    # share of the frame in each direction, rounded up to the multiple of 32 YOLO needs. Vehicles
+    # keep the pixel scale they have in a full-frame blob while the network sees fewer pixels.
+    def blob_size(self, input_size, width, height):
+        x0, y0, x1, y1 = self.bounds(width, height)
+        return tuple(max(32, int(np.ceil(input_size * part / whole / 32)) * 32)
+                     for part, whole in ((x1 - x0, width), (y1 - y0, height)))
+
+    # Lane index of each [x, y, w, h] pixel box, or -1 outside every lane
+    def lanes_of(self, boxes, width, height):
+        lanes = np.full(len(boxes), -1, dtype=int)
+        for i, (x, y, w, h) in enumerate(boxes.tolist()):
+            point = ((x + w / 2) / width, (y + h) / height)
+            for lane, polygon in enumerate(self.polygons):
+                if cv2.pointPolygonTest(polygon, point, False) >= 0:
+                    lanes[i] = lane
+                    break
+        return lanes
+
+    def draw(self, frame):
+        scale = np.array([frame.shape[1], frame.shape[0]], dtype=np.float32)
+        for polygon in self.polygons:
+            cv2.polylines(frame, [(polygon * scale).astype(np.int32)], True, (255, 0, 0), 2)
+
+
+roi_cache = {'path': None, 'signature': None, 'cameras': {}}
+
+
+# Load the ROI config, re-reading it only when the file changes; a missing file means no ROIs
+def load_roi_config(path=None):
+    path = ROI_CONFIG_PATH if path is None else path
     try:
-        with open('emergency.csv', mode='r') as file:
-            reader = csv.reader(file)
-            for row in reader:
-                if row and row[0] in ['High', 'Medium']:  # Checking for High or Medium priority
-                    return True
-    except FileNotFoundError:
-        print("emergency.csv not found.")
-    return False
+        stat = os.stat(path)
+    except OSError:
+        return {}
+    signature = (stat.st_mtime, stat.st_size)
+    if roi_cache['path'] == path and roi_cache['signature'] == signature:
+        return roi_cache['cameras']
+
+    cameras = {}
+    try:
+        with open(path, "r") as f:
+            config = json.load(f)
+        for camera, entry in config.items():
+            cameras[camera] = CameraROI([(lane.get('name', f"lane {i + 1}"), lane['polygon'])
+                                         for i, lane in enumerate(entry['lanes'])])
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        print(f"Error: Could not read ROI config {path}: {e}")
+        cameras = {}
+    roi_cache.update(path=path, signature=signature, cameras=cameras)
+    return cameras
+
+
+def roi_for_camera(video_path):
+    cameras = load_roi_config()
+    return cameras.get(video_path) or cameras.get(os.path.basename(str(video_path)))
+
+
+# Decode raw YOLO outputs into car/truck boxes using whole-array NumPy operations
+def decode_detections(outs, width, height):
+    rows = [out.reshape(-1, out.shape[-1]) for out in outs if out.shape[-1] >= 85]
+    if not rows:
+        return np.empty((0, 4), dtype=int), np.empty(0, dtype=np.float32), np.empty(0, dtype=int)
+    detections = np.concatenate(rows)
+
+    scores = detections[:, 5:]
+    class_ids = np.argmax(scores, axis=1)
+    confidences = scores[np.arange(len(scores)), class_ids]
+
+    mask = (confidences > CONFIDENCE_THRESHOLD) & np.isin(class_ids, detector.vehicle_class_ids)
+    detections = detections[mask]
+    confidences = confidences[mask]
+    class_ids = class_ids[mask]
+
+    center_x = (detections[:, 0] * width).astype(int)
+    center_y = (detections[:, 1] * height).astype(int)
+    w = (detections[:, 2] * width).astype(int)
+    h = (detections[:, 3] * height).astype(int)
+    x = (center_x - w / 2).astype(int)
+    y = (center_y - h / 2).astype(int)
 
+    boxes = np.stack([x, y, w, h], axis=1)
+    return boxes, confidences, class_ids
 
-def detect_objects(frame):
+
+def suppress_overlaps(boxes, confidences):
+    indexes = cv2.dnn.NMSBoxes(boxes.tolist(), confidences.tolist(), CONFIDENCE_THRESHOLD, NMS_THRESHOLD)
+    return np.asarray(indexes, dtype=int).flatten()
+
+
+def draw_detections(frame, boxes, class_ids):
+    color = (0, 255, 0)
+    for (x, y, w, h), class_id in zip(boxes.tolist(), class_ids.tolist()):
+        label = str(detector.classes[class_id])
+        cv2.rectangle(frame, (x, y), (x + w, y + h), color, 2)
+        cv2.putText(frame, label, (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
+
+
+# Run NMS on one frame's raw outputs, optionally draw the kept boxes, and count cars/trucks.
+# With an ROI the outputs come from the cropped frame and only vehicles inside a lane count.
+def count_vehicles(frame, outs, draw=True, roi=None):
+    if roi is not None:
+        lane_counts = count_lanes(frame, outs, roi, draw)
+        return sum(car for car, _ in lane_counts), sum(truck for _, truck in lane_counts)
+
+    classes = detector.classes
     height, width = frame.shape[:2]
-    blob = cv2.dnn.blobFromImage(frame, 0.00392, (416, 416), (0, 0, 0), True, crop=False)
-    net.setInput(blob)
-    outs = net.forward(output_layers)
-    
-    class_ids = []
-    confidences = []
-    boxes = []
-    
-    car_count = 0
-    truck_count = 0
-    
-    for out in outs:
-        for detection in out:
-            if len(detection) >= 85:
-                scores = detection[5:]
-                class_id = np.argmax(scores)
-                confidence = scores[class_id]
-                if confidence > 0.3 and classes[class_id] in ['car', 'truck']:
-                    center_x = int(detection[0] * width)
-                    center_y = int(detection[1] * height)
-                    w = int(detection[2] * width)
-                    h = int(detection[3] * height)
-                    x = int(center_x - w / 2)
-                    y = int(center_y - h / 2)
-                    
-                    boxes.append([x, y, w, h])
-                    confidences.append(float(confidence))
-                    class_ids.append(class_id)
-    
-    indexes = cv2.dnn.NMSBoxes(boxes, confidences, 0.3, 0.4)
-    for i in range(len(boxes)):
-        if i in indexes:
-            x, y, w, h = boxes[i]
-            label = str(classes[class_ids[i]])
-            color = (0, 255, 0)
-            cv2.rectangle(frame, (x, y), (x + w, y + h), color, 2)
-            cv2.putText(frame, label, (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
-            
-            if label == 'car':
-                car_count += 1
-            elif label == 'truck':
-                truck_count += 1
-    
+    boxes, confidences, class_ids = decode_detections(outs, width, height)
+    if len(boxes) == 0:
+        return 0, 0
+
+    kept = suppress_overlaps(boxes, confidences)
+    if draw:
+        draw_detections(frame, boxes[kept], class_ids[kept])
+
+    kept_class_ids = class_ids[kept]
+    car_count = int(np.count_nonzero(kept_class_ids == classes.index('car'))) if 'car' in classes else 0
+    truck_count = int(np.count_nonzero(kept_class_ids == classes.index('truck'))) if 'truck' in classes else 0
+
     return car_count, truck_count
 
 
-def process_video(video_path, duration):
+# Kept vehicle boxes of one frame in frame pixels, with their class ids and lane indexes (all 0
+# without an ROI). With an ROI the outputs come from the crop and boxes outside every lane are dropped.
+def vehicle_boxes(frame, outs, roi=None, draw=True):
+    height, width = frame.shape[:2]
+    x0, y0, x1, y1 = (0, 0, width, height) if roi is None else roi.bounds(width, height)
+    boxes, confidences, class_ids = decode_detections(outs, x1 - x0, y1 - y0)
+    lanes = np.zeros(len(boxes), dtype=int)
+    if len(boxes) > 0:
+        boxes[:, 0] += x0
+        boxes[:, 1] += y0
+        kept = suppress_overlaps(boxes, confidences)
+        boxes, class_ids, lanes = boxes[kept], class_ids[kept], lanes[kept]
+        if roi is not None:
+            lanes = roi.lanes_of(boxes, width, height)
+            inside = lanes >= 0
+            boxes, class_ids, lanes = boxes[inside], class_ids[inside], lanes[inside]
+        if draw:
+            draw_detections(frame, boxes, class_ids)
+    if draw and roi is not None:
+        roi.draw(frame)
+    return boxes, class_ids, lanes
+
+
+# (car, truck) counts per lane from vehicle_boxes() class ids and lane indexes
+def tally_lanes(class_ids, lanes, lane_total):
+    lane_counts = [[0, 0] for _ in range(lane_total)]
+    car_id = detector.classes.index('car') if 'car' in detector.classes else -1
+    for lane, class_id in zip(lanes.tolist(), class_ids.tolist()):
+        lane_counts[lane][0 if class_id == car_id else 1] += 1
+    return [tuple(counts) for counts in lane_counts]
+
+
+# Per-lane (car, truck) counts for one frame, from the outputs of its ROI crop
+def count_lanes(frame, outs, roi, draw=True):
+    _, class_ids, lanes = vehicle_boxes(frame, outs, roi, draw)
+    return tally_lanes(class_ids, lanes, len(roi.polygons))
+
+
+def make_blob(frame, roi=None):
+    if roi is None:
+        return detector.blob([frame])
+    return detector.blob([roi.crop(frame)], roi.blob_size(detector.input_size, frame.shape[1], frame.shape[0]))
+
+
+# Crops of a batch of frames and the network input size for them: the largest per-frame
+# blob size, since one blob holds the whole batch
+def crop_batch(frames, rois):
+    crops = [frame if roi is None else roi.crop(frame) for frame, roi in zip(frames, rois)]
+    sizes = [(detector.input_size, detector.input_size) if roi is None
+             else roi.blob_size(detector.input_size, frame.shape[1], frame.shape[0])
+             for frame, roi in zip(frames, rois)]
+    return crops, (max(width for width, _ in sizes), max(height for _, height in sizes))
+
+
+def detect_objects(frame, draw=True, roi=None):
+    outs = detector.forward(make_blob(frame, roi))
+    return count_vehicles(frame, outs, draw, roi)
+
+
+# Feed one inferred frame's counts to its sampler, per lane when the camera has an ROI. With a
+# VehicleTracker the frame's boxes also update the tracker, `timestamp` seconds into the video.
+def record_counts(sampler, frame, outs, roi, draw, tracker=None, timestamp=None):
+    if roi is None and tracker is None:
+        sampler.record(*count_vehicles(frame, outs, draw))
+        return
+    boxes, class_ids, lanes = vehicle_boxes(frame, outs, roi, draw)
+    if tracker is not None:
+        tracker.update(boxes, class_ids, timestamp, frame.shape[0])
+    lane_counts = tally_lanes(class_ids, lanes, 1 if roi is None else len(roi.polygons))
+    sampler.record(sum(car for car, _ in lane_counts), sum(truck for _, truck in lane_counts),
+                   None if roi is None else lane_counts)
+
+
+# Run a single forward pass over several frames and split the outputs back per frame
+def forward_batch(frames, size=None):
+    outs = detector.forward(detector.blob(frames, size))
+    per_layer = [out.reshape(len(frames), -1, out.shape[-1]) for out in outs]
+    return [[layer[i] for layer in per_layer] for i in range(len(frames))]
+
+
+# Detect cars/trucks on a batch of frames with one DNN call; rois holds one ROI (or None) per frame
+def detect_objects_batch(frames, draw=True, rois=None):
+    rois = [None] * len(frames) if rois is None else rois
+    crops, size = crop_batch(frames, rois)
+    outs_per_frame = forward_batch(crops, size)
+    return [count_vehicles(frame, outs, draw, roi) for frame, roi, outs in zip(frames, rois, outs_per_frame)]
+
+
+# Frame sampling policy used by calculate_duration. Supported modes:
+#   'all'      - run detection on every decoded frame
+#   'stride'   - run detection on every Nth frame ('stride')
+#   'fixed'    - spread 'frames_per_window' inferred frames evenly over the window
+#   'adaptive' - sample every Nth frame and stop early once the running average is stable
+SAMPLING_MODES = ['all', 'stride', 'fixed', 'adaptive']
+SAMPLING_POLICY = {'mode': 'stride', 'stride': 6}
+
+# Frames per blobFromImages batch in calculate_duration; 1 keeps one process per feed instead
+INFERENCE_BATCH_SIZE = 1
+
+# Run per-feed analysis as a threaded decode -> blob -> inference -> render pipeline
+USE_PIPELINE = True
+PIPELINE_QUEUE_SIZE = 4
+
+# Track vehicles across frames and size green time from the measured queue. While tracking,
+# TRACKING_POLICY replaces SAMPLING_POLICY as the default: detection runs on every 3rd frame and
+# the tracker carries vehicles over the frames in between (at 30 fps, gaps much over 3 frames
+# start to mix up vehicles in a slow, tightly packed queue; see the "tracking" benchmark).
+USE_TRACKING = True
+TRACKING_POLICY = {'mode': 'stride', 'stride': 3}
+
+
+# Picks which frames of a capture get inferred during one analysis window and
+# accumulates their counts. Skipped frames are only grabbed, never decoded.
+class FrameSampler:
+    def __init__(self, cap, duration, mode='all', stride=1, frames_per_window=10,
+                 min_samples=5, stable_samples=3, tolerance=0.5):
+        if mode not in SAMPLING_MODES:
+            raise ValueError(f"Unknown sampling mode {mode!r}, expected one of {SAMPLING_MODES}")
+        self.cap = cap
+        self.duration = duration
+        self.mode = mode
+        self.frames_per_window = frames_per_window
+        self.min_samples = min_samples
+        self.stable_samples = stable_samples
+        self.tolerance = tolerance
+
+        if mode == 'all':
+            stride = 1
+        self.fps = cap.get(cv2.CAP_PROP_FPS) or 30
+        self.window_frames = None
+        if mode == 'fixed':
+            self.window_frames = int(self.fps * duration)
+            stride = max(1, self.window_frames // max(1, frames_per_window))
+        self.stride = max(1, int(stride))
+
+        self.total_car_count = 0
+        self.total_truck_count = 0
+        self.lane_totals = None  # Per-lane [car, truck] sums when the camera has an ROI
+        self.frames_read = 0
+        self.frames_sampled = 0
+        self.frames_inferred = 0
+        self.previous_average = None
+        self.stable_count = 0
+        self.done = False
+        self.exhausted = False  # The capture ran out of frames (end of file or dropped stream)
+        self.start_time = time.time()
+
+    # Return the next frame to run detection on, or None once the window is over
+    def read(self):
+        while not self.done and self.cap.isOpened():
+            if time.time() - self.start_time > self.duration:
+                break
+            if self.window_frames is not None and (self.frames_read >= self.window_frames
+                                                   or self.frames_sampled >= self.frames_per_window):
+                break
+
+            if self.frames_read % self.stride != 0:
+                if not self.cap.grab():
+                    self.exhausted = True
+                    break
+                self.frames_read += 1
+                continue
+
+            ret, frame = self.cap.read()
+            if not ret:
+                self.exhausted = True
+                break
+            self.frames_read += 1
+            self.frames_sampled += 1
+            return frame
+
+        self.done = True
+        return None
+
+    # Add one inferred frame's counts; adaptive mode stops once the average settles
+    def record(self, car_count, truck_count, lane_counts=None):
+        self.total_car_count += car_count
+        self.total_truck_count += truck_count
+        self.frames_inferred += 1
+        if lane_counts is not None:
+            if self.lane_totals is None:
+                self.lane_totals = [[0, 0] for _ in lane_counts]
+            for totals, (lane_car_count, lane_truck_count) in zip(self.lane_totals, lane_counts):
+                totals[0] += lane_car_count
+                totals[1] += lane_truck_count
+
+        if self.mode == 'adaptive':
+            average = (self.total_car_count + self.total_truck_count) / self.frames_inferred
+            if self.previous_average is not None and abs(average - self.previous_average) <= self.tolerance:
+                self.stable_count += 1
+            else:
+                self.stable_count = 0
+            self.previous_average = average
+            if self.frames_inferred >= self.min_samples and self.stable_count >= self.stable_samples:
+                self.done = True
+
+    # Video time in seconds of the frame read() returned last
+    def position(self):
+        return (self.frames_read - 1) / self.fps
+
+    def averages(self):
+        if self.frames_inferred == 0:
+            return 0, 0
+        return self.total_car_count // self.frames_inferred, self.total_truck_count // self.frames_inferred
+
+    def stats(self):
+        stats = {'mode': self.mode, 'frames_read': self.frames_read, 'frames_inferred': self.frames_inferred}
+        if self.lane_totals is not None:
+            stats['lanes'] = [(car // self.frames_inferred, truck // self.frames_inferred)
+                              for car, truck in self.lane_totals]
+        return stats
+
+
+# With tracking=True a VehicleTracker follows the vehicles over the sampled frames and the stats
+# gain its unique counts, queue length and discharge rate
+def process_video(video_path, duration, return_stats=False, headless=None, tracking=False, **policy):
+    headless = HEADLESS if headless is None else headless
     cap = cv2.VideoCapture(video_path)
     if not cap.isOpened():
         print(f"Error: Could not open video file {video_path}")
-        return 0, 0
+        stats = {'mode': policy.get('mode', 'all'), 'frames_read': 0, 'frames_inferred': 0}
+        return (0, 0, stats) if return_stats else (0, 0)
 
-    total_car_count = 0
-    total_truck_count = 0
-    frame_count = 0
+    sampler = FrameSampler(cap, duration, **policy)
+    roi = roi_for_camera(video_path)
+    tracker = VehicleTracker() if tracking else None
 
-    start_time = time.time()
+    if not headless:
+        cv2.namedWindow('Frame', cv2.WINDOW_NORMAL)
+        cv2.resizeWindow('Frame', 1920, 1080)
+
+    while True:
+        frame = sampler.read()
+        if frame is None:
+            break
+
+        outs = detector.forward(make_blob(frame, roi))
+        record_counts(sampler, frame, outs, roi, not headless, tracker, sampler.position())
+
+        if not headless:
+            cv2.imshow('Frame', frame)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+
+    cap.release()
+    if not headless:
+        cv2.destroyAllWindows()
+
+    avg_car_count, avg_truck_count = sampler.averages()
+    if return_stats:
+        return avg_car_count, avg_truck_count, analysis_stats(sampler, tracker)
+    return avg_car_count, avg_truck_count
+
+
+# A sampler's stats, plus the tracker's window figures when the feed was tracked
+def analysis_stats(sampler, tracker=None):
+    stats = sampler.stats()
+    if tracker is not None:
+        stats.update(tracker.window_stats())
+    return stats
+
+
+# Pairwise IoU of two arrays of [x, y, w, h] boxes
+def box_iou(a, b):
+    left = np.maximum(a[:, None, 0], b[None, :, 0])
+    top = np.maximum(a[:, None, 1], b[None, :, 1])
+    right = np.minimum(a[:, None, 0] + a[:, None, 2], b[None, :, 0] + b[None, :, 2])
+    bottom = np.minimum(a[:, None, 1] + a[:, None, 3], b[None, :, 1] + b[None, :, 3])
+    intersection = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+    union = (a[:, None, 2] * a[:, None, 3]) + (b[None, :, 2] * b[None, :, 3]) - intersection
+    return intersection / np.maximum(union, 1e-9)
+
+
+# Tracking settings: a vehicle is queued while its centre moves slower than STOPPED_SPEED frame
+# heights per second, and is counted once it has been matched on TRACK_MIN_HITS detection passes
+STOPPED_SPEED = 0.05
+TRACK_IOU_THRESHOLD = 0.3
+TRACK_MAX_MISSED = 2
+TRACK_MIN_HITS = 2
+TRACK_VELOCITY_SECONDS = 0.5  # Time constant of the velocity estimate
+
+
+# Lightweight multi-object tracker. Each track's box is moved forward with its estimated velocity,
+# detections are matched to the predicted boxes greedily by IoU (falling back to the nearest centre
+# within one box size), unmatched detections start new tracks, and tracks missed on more than
+# TRACK_MAX_MISSED passes are closed. A confirmed track that closes while moving has left the
+# queue, which gives the discharge rate.
+class VehicleTracker:
+    def __init__(self, iou_threshold=TRACK_IOU_THRESHOLD, max_missed=TRACK_MAX_MISSED,
+                 min_hits=TRACK_MIN_HITS, stopped_speed=STOPPED_SPEED):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.min_hits = min_hits
+        self.stopped_speed = stopped_speed
+        self.ids = itertools.count(1)
+        self.tracks = []  # Live tracks: id, box, velocity, class_id, seen_at, hits, missed
+        self.frame_height = 1
+        self.last_time = None
+        self.window_start = None
+        self.window_unique = {}  # class_id -> vehicles confirmed this window
+        self.departures = 0  # Confirmed vehicles that drove off this window
+
+    def predicted_box(self, track, timestamp):
+        box = track['box'].copy()
+        box[:2] += track['velocity'] * (timestamp - track['seen_at'])
+        return box
+
+    def is_stopped(self, track):
+        return np.hypot(*track['velocity']) < self.stopped_speed * self.frame_height
+
+    def match(self, predicted, boxes):
+        pairs = []
+        if len(predicted) and len(boxes):
+            iou = box_iou(predicted, boxes)
+            for flat in np.argsort(-iou, axis=None):
+                t, d = divmod(int(flat), len(boxes))
+                if iou[t, d] < self.iou_threshold:
+                    break
+                pairs.append((t, d))
+        matched_tracks, matched_boxes, matches = set(), set(), []
+        for t, d in pairs:
+            if t not in matched_tracks and d not in matched_boxes:
+                matched_tracks.add(t)
+                matched_boxes.add(d)
+                matches.append((t, d))
+
+        # Small or fast vehicles may not overlap their prediction: fall back to centre distance
+        for d in range(len(boxes)):
+            if d in matched_boxes:
+                continue
+            centre = boxes[d, :2] + boxes[d, 2:] / 2
+            reach = boxes[d, 2:].max()
+            best = None
+            for t in range(len(predicted)):
+                if t in matched_tracks:
+                    continue
+                distance = np.hypot(*(predicted[t, :2] + predicted[t, 2:] / 2 - centre))
+                if distance <= reach and (best is None or distance < best[0]):
+                    best = (distance, t)
+            if best is not None:
+                matched_tracks.add(best[1])
+                matched_boxes.add(d)
+                matches.append((best[1], d))
+        return matches
+
+    # Feed one detection pass (boxes in pixels, their class ids) taken at `timestamp` seconds
+    def update(self, boxes, class_ids, timestamp, frame_height):
+        self.frame_height = frame_height
+        if self.last_time is not None and timestamp < self.last_time:
+            self.drop_tracks()  # The source jumped back (e.g. a looping clip)
+        if self.window_start is None:
+            self.window_start = timestamp
+        self.last_time = timestamp
+
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        predicted = np.array([self.predicted_box(track, timestamp) for track in self.tracks]).reshape(-1, 4)
+        matches = self.match(predicted, boxes)
+
+        matched_tracks, matched_boxes = set(), set()
+        for t, d in matches:
+            track = self.tracks[t]
+            elapsed = timestamp - track['seen_at']
+            if elapsed > 0:
+                velocity = (boxes[d, :2] + boxes[d, 2:] / 2 - track['box'][:2] - track['box'][2:] / 2) / elapsed
+                weight = min(1.0, elapsed / TRACK_VELOCITY_SECONDS)  # Average out box jitter on close frames
+                track['velocity'] = (1 - weight) * track['velocity'] + weight * velocity
+            track.update(box=boxes[d].copy(), seen_at=timestamp, missed=0)
+            track['hits'] += 1
+            if track['hits'] == self.min_hits:
+                self.window_unique[track['class_id']] = self.window_unique.get(track['class_id'], 0) + 1
+            matched_tracks.add(t)
+            matched_boxes.add(d)
+
+        live = []
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track['missed'] += 1
+            if track['missed'] <= self.max_missed:
+                live.append(track)
+            elif track['hits'] >= self.min_hits and not self.is_stopped(track):
+                self.departures += 1
+        for d in range(len(boxes)):
+            if d not in matched_boxes:
+                live.append({'id': next(self.ids), 'box': boxes[d].copy(), 'velocity': np.zeros(2),
+                             'class_id': int(class_ids[d]), 'seen_at': timestamp, 'hits': 1, 'missed': 0})
+        self.tracks = live
+
+    # Forget live tracks without counting them as departures
+    def drop_tracks(self):
+        self.tracks = []
+        self.last_time = None
+
+    def queue_length(self):
+        return sum(1 for track in self.tracks if track['hits'] >= self.min_hits and self.is_stopped(track))
+
+    # Unique vehicles, current queue and discharge rate (vehicles/sec) since the previous call
+    def window_stats(self):
+        span = 0
+        if self.last_time is not None and self.window_start is not None:
+            span = self.last_time - self.window_start
+        car_id = detector.classes.index('car') if 'car' in detector.classes else -1
+        unique_cars = self.window_unique.get(car_id, 0)
+        stats = {'unique_vehicles': sum(self.window_unique.values()), 'unique_cars': unique_cars,
+                 'unique_trucks': sum(self.window_unique.values()) - unique_cars,
+                 'queue_length': self.queue_length(),
+                 'discharge_rate': self.departures / span if span > 0 else 0.0}
+        self.window_unique = {}
+        self.departures = 0
+        self.window_start = self.last_time
+        return stats
 
-    cv2.namedWindow('Frame', cv2.WINDOW_NORMAL)
-    cv2.resizeWindow('Frame', 1920, 1080)
 
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
+# Analyse several feeds in one process, packing sampled frames from all of them
+# into blobFromImages batches. Returns (avg_car, avg_truck, stats) per feed, in order.
+def process_videos_batched(video_paths, duration, batch_size=4, headless=None, **policy):
+    headless = HEADLESS if headless is None else headless
+    samplers = []
+    rois = [roi_for_camera(video_path) for video_path in video_paths]
+    for video_path in video_paths:
+        cap = cv2.VideoCapture(video_path)
+        if not cap.isOpened():
+            print(f"Error: Could not open video file {video_path}")
+            samplers.append(None)
+            continue
+        samplers.append(FrameSampler(cap, duration, **policy))
+
+    pending = []  # (stream index, frame) waiting for the next batch
+    stopped = False
+
+    def flush():
+        crops, size = crop_batch([frame for _, frame in pending], [rois[stream] for stream, _ in pending])
+        for (stream, frame), outs in zip(pending, forward_batch(crops, size)):
+            record_counts(samplers[stream], frame, outs, rois[stream], not headless)
+            if not headless:
+                cv2.imshow(f'Frame {stream + 1}', frame)
+        pending.clear()
+        return not headless and cv2.waitKey(1) & 0xFF == ord('q')
+
+    while not stopped:
+        active = [i for i, sampler in enumerate(samplers) if sampler is not None and not sampler.done]
+        if not active:
             break
+        for stream in active:
+            frame = samplers[stream].read()
+            if frame is not None:
+                pending.append((stream, frame))
+            if len(pending) >= batch_size:
+                stopped = flush()
+                if stopped:
+                    break
+    if pending and not stopped:
+        flush()
+
+    results = []
+    for sampler in samplers:
+        if sampler is None:
+            results.append((0, 0, {'mode': policy.get('mode', 'all'), 'frames_read': 0, 'frames_inferred': 0}))
+            continue
+        sampler.cap.release()
+        results.append(sampler.averages() + (sampler.stats(),))
+    if not headless:
+        cv2.destroyAllWindows()
+    return results
+
+
+# Put an item on a bounded queue without blocking forever once the pipeline is stopping
+def put_until_stopped(q, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+# Take an item from a queue, giving up (returning None) once the pipeline is stopping
+def get_until_stopped(q, stop_event):
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return None
+
+
+# Same result as process_video, but decode, blob creation and inference run in their own
+# threads connected by bounded queues so they overlap. Rendering stays on the calling thread
+# (some platforms only allow GUI calls there) and is skipped entirely when headless.
+def process_video_pipelined(video_path, duration, return_stats=False, headless=None, tracking=False,
+                            queue_size=PIPELINE_QUEUE_SIZE, **policy):
+    headless = HEADLESS if headless is None else headless
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Error: Could not open video file {video_path}")
+        stats = {'mode': policy.get('mode', 'all'), 'frames_read': 0, 'frames_inferred': 0}
+        return (0, 0, stats) if return_stats else (0, 0)
+
+    sampler = FrameSampler(cap, duration, **policy)
+    roi = roi_for_camera(video_path)
+    tracker = VehicleTracker() if tracking else None
+    stop_event = threading.Event()
+    decoded = queue.Queue(maxsize=queue_size)
+    blobs = queue.Queue(maxsize=queue_size)
+    rendered = queue.Queue(maxsize=queue_size)
+    errors = []  # Exceptions raised inside the stages, re-raised by the calling thread
+
+    def decode_stage():
+        while not stop_event.is_set():
+            frame = sampler.read()
+            if frame is None or not put_until_stopped(decoded, (frame, sampler.position()), stop_event):
+                break
 
-        car_count, truck_count = detect_objects(frame)
-        total_car_count += car_count
-        total_truck_count += truck_count
-        frame_count += 1
+    def blob_stage():
+        while True:
+            item = get_until_stopped(decoded, stop_event)
+            if item is None or not put_until_stopped(blobs, item + (make_blob(item[0], roi),), stop_event):
+                break
 
+    def inference_stage():
+        while True:
+            item = get_until_stopped(blobs, stop_event)
+            if item is None:
+                break
+            frame, position, blob = item
+            outs = detector.forward(blob)
+            record_counts(sampler, frame, outs, roi, not headless, tracker, position)
+            if not headless and not put_until_stopped(rendered, frame, stop_event):
+                break
+
+    # A failing stage stops the whole pipeline; every stage ends by passing None downstream
+    def run_stage(stage, output):
+        try:
+            stage()
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+        finally:
+            put_until_stopped(output, None, stop_event)
+
+    stages = [threading.Thread(target=run_stage, args=stage, daemon=True)
+              for stage in ((decode_stage, decoded), (blob_stage, blobs), (inference_stage, rendered))]
+    for stage in stages:
+        stage.start()
+
+    if not headless:
+        cv2.namedWindow('Frame', cv2.WINDOW_NORMAL)
+        cv2.resizeWindow('Frame', 1920, 1080)
+    while True:
+        frame = get_until_stopped(rendered, stop_event) if not headless else None
+        if frame is None:
+            break
         cv2.imshow('Frame', frame)
         if cv2.waitKey(1) & 0xFF == ord('q'):
+            stop_event.set()
             break
 
-        elapsed_time = time.time() - start_time
-        if elapsed_time > duration:
-            break
-
+    if headless:
+        stages[-1].join()
+    stop_event.set()
+    for stage in stages:
+        stage.join()
     cap.release()
-    cv2.destroyAllWindows()
-
-    avg_car_count = total_car_count // frame_count if frame_count > 0 else 0
-    avg_truck_count = total_truck_count // frame_count if frame_count > 0 else 0
+    if not headless:
+        cv2.destroyAllWindows()
+    if errors:
+        raise errors[0]
 
+    avg_car_count, avg_truck_count = sampler.averages()
+    if return_stats:
+        return avg_car_count, avg_truck_count, analysis_stats(sampler, tracker)
     return avg_car_count, avg_truck_count
 
 
-def calculate_duration():
-    avg_car_count1, avg_truck_count1 = process_video(video_path1, 5)
-    avg_car_count2, avg_truck_count2 = process_video(video_path2, 5)
+# Pool worker initializer: load (and warm up) the worker's own net before the first task.
+# A failure is only logged here (raising would break the pool); the task retries the load and
+# raises the error to the caller.
+def init_analysis_worker():
+    try:
+        detector.load(warm_up=WARM_UP_MODEL)
+    except Exception as e:
+        print(f"Error: Could not load the detection model: {e}")
+
+
+# Pool task: analyse one approach and return its counts with sampling stats
+def analyse_approach(task):
+    video_path, duration, policy = task
+    analyse = process_video_pipelined if USE_PIPELINE else process_video
+    avg_car_count, avg_truck_count, stats = analyse(video_path, duration, return_stats=True,
+                                                    tracking=USE_TRACKING, **policy)
+    stats['model'] = detector.report()
+    return avg_car_count, avg_truck_count, stats
+
+
+analysis_pool = None
+analysis_pool_workers = 0
+
+
+# Reuse one process pool across signal cycles so workers keep their nets loaded
+def get_analysis_pool(workers):
+    global analysis_pool, analysis_pool_workers
+    if analysis_pool is None or analysis_pool_workers < workers:
+        if analysis_pool is not None:
+            analysis_pool.shutdown()
+        analysis_pool = ProcessPoolExecutor(max_workers=workers, initializer=init_analysis_worker)
+        analysis_pool_workers = workers
+    return analysis_pool
 
-    combined_count_video1 = avg_car_count1 + avg_truck_count1
-    combined_count_video2 = avg_car_count2 + avg_truck_count2
 
+# Analyse all camera feeds concurrently; latency is bounded by the slowest feed
+def analyse_approaches(video_paths, duration, policy=None):
+    if policy is None:
+        policy = TRACKING_POLICY if USE_TRACKING else SAMPLING_POLICY
+    pool = get_analysis_pool(len(video_paths))
+    tasks = [(video_path, duration, policy) for video_path in video_paths]
+    return list(pool.map(analyse_approach, tasks))
+
+
+# Queue-based green time: start-up lost time plus the time to discharge the measured queue
+STARTUP_LOST_SECONDS = 2
+MIN_GREEN_SECONDS = 5
+MAX_GREEN_SECONDS = 90
+DEFAULT_DISCHARGE_RATE = 0.5  # Vehicles/sec per approach until a discharge has been observed
+MIN_DISCHARGE_RATE = 0.2  # Floor for observed rates, so a trickle seen on red cannot inflate green
+DISCHARGE_SMOOTHING = 0.3  # Weight of each new window's discharge rate in the running estimate
+
+
+# Smoothed discharge rate per approach for one intersection (or one analyzer). Feed it every
+# analysis window once, as it is produced; windows with no discharge keep the previous estimate.
+class DischargeEstimator:
+    def __init__(self, smoothing=DISCHARGE_SMOOTHING):
+        self.smoothing = smoothing
+        self.rates = {}  # approach index -> smoothed observed discharge rate
+
+    # Blend in one window's rate and return the current estimate (0 until a discharge was seen)
+    def observe(self, approach, discharge_rate):
+        if discharge_rate > 0:
+            previous = self.rates.get(approach)
+            self.rates[approach] = (discharge_rate if previous is None
+                                    else (1 - self.smoothing) * previous + self.smoothing * discharge_rate)
+        return self.rates.get(approach, 0.0)
+
+    # observe() every approach of one window of (queue length, discharge rate) pairs
+    def observe_all(self, queues):
+        return [(queue_length, self.observe(approach, discharge_rate))
+                for approach, (queue_length, discharge_rate) in enumerate(queues)]
+
+
+# Turn per-approach (queue length, discharge rate) into green durations. The rates are used as
+# given (smooth them with a DischargeEstimator first); 0 means none observed yet.
+def queue_green_durations(queues):
+    durations = []
+    for queue_length, discharge_rate in queues:
+        rate = max(discharge_rate if discharge_rate > 0 else DEFAULT_DISCHARGE_RATE, MIN_DISCHARGE_RATE)
+        green = STARTUP_LOST_SECONDS + queue_length / rate if queue_length > 0 else MIN_GREEN_SECONDS
+        durations.append(min(MAX_GREEN_SECONDS, max(MIN_GREEN_SECONDS, green)))
+    return tuple(durations)
+
+
+# Turn per-approach (car, truck) counts into green durations
+def green_durations(counts):
     rate = 1.5
-    duration_per_vehicle1 = rate * combined_count_video1 if combined_count_video1 > 0 else 5
-    duration_per_vehicle2 = rate * combined_count_video2 if combined_count_video2 > 0 else 5
+    durations = []
+    for avg_car_count, avg_truck_count in counts:
+        combined_count = avg_car_count + avg_truck_count
+        durations.append(rate * combined_count if combined_count > 0 else 5)
+    return tuple(durations)
+
+
+# Analyse every approach once (the configured video_paths unless `paths` is given) and size
+# green time. Pass a DischargeEstimator kept for the intersection to smooth the discharge rates
+# over successive calls.
+def calculate_duration(discharge=None, paths=None):
+    paths = video_paths if paths is None else paths
+    start_time = time.time()
+    if INFERENCE_BATCH_SIZE > 1:
+        if USE_TRACKING:
+            print("USE_TRACKING is ignored when INFERENCE_BATCH_SIZE > 1; sizing green time from counts")
+        results = process_videos_batched(paths, 5, INFERENCE_BATCH_SIZE, **SAMPLING_POLICY)
+    else:
+        results = analyse_approaches(paths, 5)
+    print(f"Analysed {len(paths)} approaches in {time.time() - start_time:.2f} seconds")
+
+    for index, (avg_car_count, avg_truck_count, stats) in enumerate(results, start=1):
+        print(f"Approach {index}: {avg_car_count} cars, {avg_truck_count} trucks, "
+              f"{stats['frames_inferred']}/{stats['frames_read']} frames inferred "
+              f"({stats.get('model', detector.report())})")
+        for lane, (lane_car_count, lane_truck_count) in enumerate(stats.get('lanes', []), start=1):
+            print(f"  lane {lane}: {lane_car_count} cars, {lane_truck_count} trucks")
+        if 'queue_length' in stats:
+            print(f"  {stats['unique_vehicles']} unique vehicles, queue {stats['queue_length']}, "
+                  f"discharge {stats['discharge_rate']:.2f} vehicles/sec")
+
+    if all('queue_length' in stats for _, _, stats in results):
+        queues = [(stats['queue_length'], stats['discharge_rate']) for _, _, stats in results]
+        return queue_green_durations(queues if discharge is None else discharge.observe_all(queues))
+    return green_durations([(car, truck) for car, truck, _ in results])
+
+
+# Background worker for one approach: keeps its capture open and keeps publishing the
+# latest window's counts into the shared array until asked to stop.
+def run_background_analyzer(index, video_path, window, policy, headless, shared_counts, stop_event,
+                            tracking=False):
+    init_analysis_worker()
+    print(f"Approach {index + 1}: {detector.report()}")
+    roi = roi_for_camera(video_path)
+    tracker = VehicleTracker() if tracking else None
+    discharge = DischargeEstimator()  # Smoothed over every window this worker publishes
+    video_time = 0.0  # Seconds of video consumed so far, the tracker's clock
+    cap = cv2.VideoCapture(video_path)
+    while not stop_event.is_set():
+        if not cap.isOpened():
+            print(f"Error: Could not open video file {video_path}, retrying")
+            time.sleep(1)
+            cap = cv2.VideoCapture(video_path)
+            continue
+
+        sampler = FrameSampler(cap, window, **policy)
+        while not stop_event.is_set():
+            frame = sampler.read()
+            if frame is None:
+                break
+            outs = detector.forward(make_blob(frame, roi))
+            record_counts(sampler, frame, outs, roi, not headless, tracker, video_time + sampler.position())
+            if not headless:
+                cv2.imshow(f'Frame {index + 1}', frame)
+                cv2.waitKey(1)
+        video_time += sampler.frames_read / sampler.fps
+
+        if sampler.frames_inferred > 0:
+            avg_car_count, avg_truck_count = sampler.averages()
+            queue_length, discharge_rate = 0, 0.0
+            if tracking:
+                stats = tracker.window_stats()
+                queue_length, discharge_rate = stats['queue_length'], discharge.observe(index, stats['discharge_rate'])
+            with shared_counts.get_lock():
+                offset = index * ANALYZER_FIELDS
+                shared_counts[offset:offset + ANALYZER_FIELDS] = [avg_car_count, avg_truck_count,
+                                                                  sampler.frames_inferred, time.time(),
+                                                                  queue_length, discharge_rate]
+
+        # Recorded clips loop from the start; live streams that dropped are reopened
+        if sampler.exhausted:
+            if tracking:
+                tracker.drop_tracks()
+            if not cap.set(cv2.CAP_PROP_POS_FRAMES, 0):
+                cap.release()
+                cap = cv2.VideoCapture(video_path)
+    cap.release()
+
+
+ANALYZER_FIELDS = 6  # car count, truck count, frames inferred, publish timestamp, queue length, discharge rate
+
+# Counts older than this (or never published) are not used; green_durations() analyses the videos
+# directly until the worker publishes again. Generous, as one window on a slow CPU takes a while.
+ANALYZER_MAX_AGE_SECONDS = 60
+
+
+# Long-running analysis service: one process per approach continuously publishes the latest
+# counts into shared memory, and snapshot() reads them without waiting on inference.
+class TrafficAnalyzerService:
+    def __init__(self, video_paths, window=5, policy=None, headless=True, tracking=None,
+                 max_age=ANALYZER_MAX_AGE_SECONDS):
+        self.video_paths = list(video_paths)
+        self.window = window
+        self.max_age = max_age
+        self.headless = headless
+        self.tracking = USE_TRACKING if tracking is None else tracking
+        if policy is None:
+            policy = TRACKING_POLICY if self.tracking else SAMPLING_POLICY
+        self.policy = policy
+        self.shared_counts = multiprocessing.Array('d', len(self.video_paths) * ANALYZER_FIELDS)
+        self.stop_event = multiprocessing.Event()
+        self.workers = []
+        self.discharge = DischargeEstimator()  # For the calculate_duration fallback
+
+    def start(self):
+        for index, video_path in enumerate(self.video_paths):
+            worker = multiprocessing.Process(
+                target=run_background_analyzer,
+                args=(index, video_path, self.window, self.policy, self.headless,
+                      self.shared_counts, self.stop_event, self.tracking),
+                daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        return self
+
+    # Latest (car, truck, updated_at) per approach; updated_at is 0 until the first publish
+    def snapshot(self):
+        with self.shared_counts.get_lock():
+            values = self.shared_counts[:]
+        return [(int(values[i]), int(values[i + 1]), values[i + 3])
+                for i in range(0, len(values), ANALYZER_FIELDS)]
+
+    # Latest (queue length, smoothed discharge rate) per approach from the tracking workers
+    def queues(self):
+        with self.shared_counts.get_lock():
+            values = self.shared_counts[:]
+        return [(int(values[i + 4]), values[i + 5]) for i in range(0, len(values), ANALYZER_FIELDS)]
+
+    # Why the published values cannot be trusted right now: workers that exited, and approaches
+    # with no publish within max_age seconds. Empty when all is well.
+    def problems(self):
+        now = time.time()
+        problems = []
+        for index, (worker, (_, _, updated_at)) in enumerate(zip(self.workers, self.snapshot())):
+            if not worker.is_alive():
+                problems.append(f"approach {index + 1} worker exited with code {worker.exitcode}")
+            elif not updated_at:
+                problems.append(f"approach {index + 1} has not published yet")
+            elif now - updated_at > self.max_age:
+                problems.append(f"approach {index + 1} last published {now - updated_at:.0f} seconds ago")
+        return problems
 
-    return duration_per_vehicle1, duration_per_vehicle2
+    # Green durations from the latest publish: sized from the queues when the workers track vehicles.
+    # If a worker died or its counts are stale, the videos are analysed directly instead (slow).
+    def green_durations(self):
+        problems = self.problems()
+        if problems:
+            print(f"Background analyzer unavailable ({'; '.join(problems)}); analysing the videos directly")
+            return calculate_duration(self.discharge, self.video_paths)
+        if self.tracking:
+            return queue_green_durations(self.queues())
+        return green_durations([(car, truck) for car, truck, _ in self.snapshot()])
+
+    # Block until every approach has published at least once; False if the timeout passes or a
+    # worker exits first
+    def wait_ready(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while not all(updated_at for _, _, updated_at in self.snapshot()):
+            if not all(worker.is_alive() for worker in self.workers):
+                return False
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    # Start the workers and wait for their first counts, reporting any that are not ready
+    def start_and_wait(self, timeout=30):
+        self.start()
+        if not self.wait_ready(timeout):
+            print(f"Background analyzer not ready ({'; '.join(self.problems())}); "
+                  "green time is sized by analysing the videos directly until it is")
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+
+# Use a persistent TrafficAnalyzerService instead of re-analysing the videos every cycle
+USE_BACKGROUND_ANALYZER = True
 
 
 # Modified control_signals function
 def control_signals():
+    analyzer = None
+    discharge = DischargeEstimator()
+    if USE_BACKGROUND_ANALYZER:
+        analyzer = TrafficAnalyzerService(video_paths, headless=HEADLESS).start_and_wait(timeout=30)
+
     while True:
         # Check if there's an emergency every second
         if check_emergency_priority():
@@ -146,7 +1226,10 @@ def control_signals():
             countdown(60)  # Signal 1 stays green for 60 seconds in case of High or Medium priority
         else:
             # Regular signal logic
-            duration_per_vehicle1, duration_per_vehicle2 = calculate_duration()
+            if analyzer is not None:
+                duration_per_vehicle1, duration_per_vehicle2 = analyzer.green_durations()
+            else:
+                duration_per_vehicle1, duration_per_vehicle2 = calculate_duration(discharge)
             print(f"Signal 1 is GREEN for {duration_per_vehicle1:.2f} seconds")
             countdown(duration_per_vehicle1)
 
@@ -167,10 +1250,338 @@ def countdown(duration):
     print("\n")
 
 
+# Real-time clock for the asyncio controller
+class SystemClock:
+    def time(self):
+        return time.monotonic()
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(max(0, seconds))
+
+    async def run_until(self, until):
+        await self.sleep(until - self.time())
+
+
+# Simulated clock: sleeping tasks are woken in timestamp order without really waiting,
+# so hours of signal operation run in milliseconds. run_until() drives time forward.
+class VirtualClock:
+    def __init__(self, start=0.0, settle_steps=10):
+        self.now = start
+        self.settle_steps = settle_steps  # Event-loop passes allowed for woken tasks to block again
+        self.timers = []  # Heap of (when, sequence, future or callback)
+        self.sequence = itertools.count()
+
+    def time(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.timers, (self.now + max(0, seconds), next(self.sequence), future))
+        await future
+
+    # Schedule a plain callback at a virtual timestamp (e.g. inject an emergency in a test)
+    def call_at(self, when, callback):
+        heapq.heappush(self.timers, (when, next(self.sequence), callback))
+
+    async def run_until(self, until):
+        while True:
+            for _ in range(self.settle_steps):
+                await asyncio.sleep(0)
+            while self.timers and isinstance(self.timers[0][2], asyncio.Future) and self.timers[0][2].done():
+                heapq.heappop(self.timers)  # Drop cancelled sleeps
+            if not self.timers or self.timers[0][0] > until:
+                self.now = max(self.now, until)
+                return
+            when, _, target = heapq.heappop(self.timers)
+            self.now = max(self.now, when)
+            if isinstance(target, asyncio.Future):
+                target.set_result(None)
+            else:
+                target()
+
+
+# Scheduling order of emergency levels (lower is more urgent)
+LEVEL_PRIORITY = {'High': 0, 'Medium': 1, 'Low': 2}
+
+# How long an emergency that is never served stays queued
+EMERGENCY_TTL_SECONDS = 180
+
+# Axis of travel (degrees) of the traffic each signal serves: Signal 1, Signal 2, ... Each signal
+# serves both directions along its axis, so 0.0 covers northbound and southbound traffic.
+APPROACH_HEADINGS = [0.0, 90.0]
+
+
+# Pick the approach whose axis of travel is closest to a vehicle heading, in either direction
+def approach_for_heading(heading, approach_headings=None):
+    approach_headings = APPROACH_HEADINGS if approach_headings is None else approach_headings
+    if heading is None or not approach_headings:
+        return 0
+    return min(range(len(approach_headings)),
+               key=lambda i: abs((heading - approach_headings[i] + 90) % 180 - 90))
+
+
+# Priority queue of active emergencies, ordered by level and then by expected arrival.
+# Entries are keyed by driver: a repeated request updates the entry in place (lazily
+# replacing its heap item), and entries leave the queue once served or after their TTL.
+# peek() is amortised O(1), so the controller can consult it on every tick.
+class EmergencyScheduler:
+    def __init__(self, clock, ttl=EMERGENCY_TTL_SECONDS):
+        self.clock = clock
+        self.ttl = ttl
+        self.heap = []  # (priority, expected arrival, sequence, key, version)
+        self.entries = {}  # key -> entry dict
+        self.sequence = itertools.count()
+
+    def add(self, key, level='High', approach=0, eta=None, hold_seconds=None):
+        now = self.clock.time()
+        level = str(level).capitalize()
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = {'key': key, 'version': 0, 'served_seconds': 0.0}
+            self.entries[key] = entry
+        entry['version'] += 1
+        entry.update(level=level, approach=approach, expires_at=now + self.ttl,
+                     green_until=None if hold_seconds is None else now + hold_seconds)
+        arrival = now + (eta or 0)
+        heapq.heappush(self.heap, (LEVEL_PRIORITY.get(level, len(LEVEL_PRIORITY)), arrival,
+                                   next(self.sequence), key, entry['version']))
+        return entry
+
+    # Most urgent live entry, or None; stale and expired heap items are dropped on the way
+    def peek(self):
+        now = self.clock.time()
+        while self.heap:
+            _, _, _, key, version = self.heap[0]
+            entry = self.entries.get(key)
+            if entry is None or entry['version'] != version:
+                heapq.heappop(self.heap)
+                continue
+            if entry['expires_at'] <= now:
+                heapq.heappop(self.heap)
+                del self.entries[key]
+                continue
+            return entry
+        return None
+
+    def served(self, key):
+        self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Event-driven controller for one intersection. Phase timers are awaited on the injected
+# clock and are cut short as soon as an emergency is queued. Emergencies are served one at a
+# time from an EmergencyScheduler, most urgent first, on the approach the vehicle arrives from.
+class IntersectionController:
+    def __init__(self, name, durations_source, clock=None, emergency_source=None,
+                 emergency_green=60, emergency_poll_interval=1, log=print, signal=None):
+        self.name = name
+        self.signal = signal  # (lat, lon) of the signal post this controller drives, None for any
+        self.durations_source = durations_source  # Callable returning green durations per approach (or an awaitable)
+        self.clock = clock or SystemClock()
+        self.emergency_source = emergency_source  # Optional polled source of new (driver_id, level) emergencies
+        self.emergency_green = emergency_green
+        self.emergency_poll_interval = emergency_poll_interval
+        self.log = log
+        self.emergency_event = asyncio.Event()
+        self.scheduler = EmergencyScheduler(self.clock)
+        self.green_approach = None
+        self.phase_history = []  # (start time, approach, planned duration, reason)
+        self.preemptions = 0
+
+    # Queue an emergency. hold_seconds replaces emergency_green with an ETA-based crossing window
+    # counted from now; a later call for the same driver updates (e.g. extends) its entry.
+    def raise_emergency(self, approach=0, hold_seconds=None, driver_id=None, level='High', eta=None):
+        key = driver_id if driver_id is not None else f"approach-{approach}"
+        self.scheduler.add(key, level, approach, eta, hold_seconds)
+        self.emergency_event.set()
+
+    # Whether a preemption request for the post at (signal_lat, signal_lon) is meant for this controller
+    def serves(self, signal_lat, signal_lon):
+        if self.signal is None:
+            return True
+        return (abs(float(signal_lat) - self.signal[0]) <= SIGNAL_MATCH_DEGREES
+                and abs(float(signal_lon) - self.signal[1]) <= SIGNAL_MATCH_DEGREES)
+
+    def start_phase(self, approach, duration, reason):
+        self.green_approach = approach
+        self.phase_history.append((self.clock.time(), approach, duration, reason))
+        self.log(f"[{self.name}] Signal {approach + 1} is GREEN for {duration:.2f} seconds ({reason})")
+
+    # Wait out a phase; returns True if an emergency preempted it
+    async def wait_phase(self, duration, preemptible=True):
+        if not preemptible:
+            await self.clock.sleep(duration)
+            return False
+        timer = asyncio.ensure_future(self.clock.sleep(duration))
+        emergency = asyncio.ensure_future(self.emergency_event.wait())
+        done, pending = await asyncio.wait({timer, emergency}, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        return emergency in done
+
+    async def watch_emergencies(self):
+        while True:
+            for driver_id, level in self.emergency_source():
+                self.raise_emergency(driver_id=driver_id, level=level)
+            await self.clock.sleep(self.emergency_poll_interval)
+
+    # Serve the most urgent queued emergency. The phase is interrupted whenever the queue
+    # changes, and the next pass re-picks the top entry, continuing its remaining green time.
+    async def serve_emergency(self, entry):
+        now = self.clock.time()
+        if entry['green_until'] is not None:
+            green = entry['green_until'] - now
+        else:
+            green = self.emergency_green - entry['served_seconds']
+        if green <= 0:
+            self.scheduler.served(entry['key'])
+            return
+
+        self.emergency_event.clear()
+        self.start_phase(entry['approach'], green, f"emergency {entry['level']} {entry['key']}")
+        if await self.wait_phase(green):
+            entry['served_seconds'] += self.clock.time() - now
+        else:
+            self.scheduler.served(entry['key'])
+
+    async def run(self):
+        watcher = asyncio.ensure_future(self.watch_emergencies()) if self.emergency_source else None
+        try:
+            while True:
+                entry = self.scheduler.peek()
+                if entry is not None:
+                    await self.serve_emergency(entry)
+                    continue
+                self.emergency_event.clear()
+
+                durations = self.durations_source()
+                if inspect.isawaitable(durations):
+                    durations = await durations
+                    if self.emergency_event.is_set():
+                        continue  # An emergency arrived while the durations were computed
+                for approach, duration in enumerate(durations):
+                    self.start_phase(approach, duration, "traffic")
+                    if await self.wait_phase(duration):
+                        self.preemptions += 1
+                        self.log(f"[{self.name}] Phase preempted by emergency")
+                        break
+                await asyncio.sleep(0)
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+
+
+# Emergency source for the controller: High/Medium registrations appended to emergency.csv
+# since the controller started (rows already in the file are not replayed)
+def registration_source(registry=None):
+    registry = emergency_registry if registry is None else registry
+    _, cursor = registry.rows_since(None)
+
+    def poll():
+        nonlocal cursor
+        rows, cursor = registry.rows_since(cursor)
+        return [(driver_id, level) for level, driver_id in rows if level in ACTIVE_LEVELS]
+    return poll
+
+
+# Run several intersections in one process until `duration` seconds of clock time have passed
+async def run_intersections(controllers, clock, duration=None):
+    tasks = [asyncio.ensure_future(controller.run()) for controller in controllers]
+    try:
+        if duration is None:
+            await asyncio.gather(*tasks)
+        else:
+            await clock.run_until(clock.time() + duration)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# Asyncio replacement for control_signals: emergencies preempt the running phase immediately
+def control_signals_async():
+    analyzer = None
+    discharge = DischargeEstimator()
+    durations_source = lambda: calculate_duration(discharge)
+    if USE_BACKGROUND_ANALYZER:
+        analyzer = TrafficAnalyzerService(video_paths, headless=HEADLESS).start_and_wait(timeout=30)
+        durations_source = analyzer.green_durations
+
+    async def run():
+        clock = SystemClock()
+        loop = asyncio.get_running_loop()
+        # Analysis (calculate_duration, or the analyzer's fallback to it) takes seconds, so it runs
+        # on an executor thread while the loop keeps serving emergencies and bus messages
+        controller = IntersectionController("Intersection 1", lambda: loop.run_in_executor(None, durations_source),
+                                            clock, emergency_source=registration_source(), signal=SIGNAL_POSITION)
+        bus_bridge = None
+        if USE_MESSAGE_BUS:
+            if SIGNAL_POSITION is None:
+                print("TRAFFIC_SIGNAL is not set; accepting preemption requests for every signal post")
+            bus = MessageBus()
+            connect_controller_to_bus(bus, controller, loop)
+            bus_bridge = SocketBridge(bus, listen_port=BUS_PORTS['controller']).start()
+        try:
+            await run_intersections([controller], clock)
+        finally:
+            if bus_bridge is not None:
+                bus_bridge.stop()
+
+    try:
+        asyncio.run(run())
+    finally:
+        if analyzer is not None:
+            analyzer.stop()
+
+
+# Preempt the controller as soon as a preemption request for its signal post or a High/Medium
+# registration arrives on the bus. Bus callbacks run on the bridge thread, so hand over to the
+# controller's loop.
+def connect_controller_to_bus(bus, controller, loop):
+    def on_preemption(message):
+        if not controller.serves(message.signal_lat, message.signal_lon):
+            return
+        loop.call_soon_threadsafe(lambda: controller.raise_emergency(
+            approach_for_heading(message.heading), message.hold_seconds, message.driver_id,
+            message.level, message.eta))
+
+    def on_registration(message):
+        if message.level in ACTIVE_LEVELS:
+            loop.call_soon_threadsafe(lambda: controller.raise_emergency(driver_id=message.driver_id,
+                                                                         level=message.level))
+
+    bus.subscribe(PreemptionRequest, on_preemption)
+    bus.subscribe(EmergencyRegistration, on_registration)
+
+
+# Listen for bus messages from EmergencyApp and check.py in control_signals_async
+USE_MESSAGE_BUS = True
+
+# Coordinates of the signal post this controller drives (TRAFFIC_SIGNAL="lat,lon"). check.py
+# publishes a PreemptionRequest for whichever post in signal_coor.csv an ambulance nears, so
+# requests naming any other post (further than SIGNAL_MATCH_DEGREES away) are dropped.
+SIGNAL_POSITION = None
+if os.environ.get('TRAFFIC_SIGNAL'):
+    SIGNAL_POSITION = tuple(float(value) for value in os.environ['TRAFFIC_SIGNAL'].split(','))
+SIGNAL_MATCH_DEGREES = 1e-4
+
+
+# Use the event-driven asyncio controller instead of the countdown loop
+USE_ASYNC_CONTROLLER = True
+
+
 # Video paths (for testing purposes)
 video_path1 = "C:\\Users\\welcome\\Downloads\\3206967-uhd_3840_2160_30fps.mp4"
 video_path2 = "C:\\Users\\welcome\\Downloads\\19696722-hd_1080_1920_30fps.mp4"
+video_paths = [video_path1, video_path2]  # One camera feed per approach
+if os.environ.get('TRAFFIC_VIDEOS'):
+    video_paths = os.environ['TRAFFIC_VIDEOS'].split(os.pathsep)
 
 
 if __name__ == "__main__":
-    control_signals()
+    if USE_ASYNC_CONTROLLER:
+        control_signals_async()
+    else:
+        control_signals()
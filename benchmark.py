@@ -0,0 +1,459 @@
+import asyncio
+import csv
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+import TrafficSIgnalComputerVision as tscv
+import check
+from emergency_registry import EmergencyRegistry
+from message_bus import MessageBus, PositionUpdate, PreemptionRequest, SocketBridge, position_update
+
+
+# Build random YOLOv3 outputs for a 416x416 input (3 scales, ~10k candidate rows)
+def make_synthetic_outs(seed=0):
+    rng = np.random.default_rng(seed)
+    outs = []
+    for grid in (13, 26, 52):
+        out = np.zeros((grid * grid * 3, 85), dtype=np.float32)
+        out[:, :4] = rng.random((len(out), 4), dtype=np.float32)
+        out[:, 2:4] *= 0.3
+        out[:, 5:] = rng.random((len(out), 80), dtype=np.float32) * 0.35
+        outs.append(out)
+    return outs
+
+
+# Original per-row decode loop, kept here as the baseline for comparison
+def legacy_postprocess(outs, width, height):
+    class_ids = []
+    confidences = []
+    boxes = []
+    car_count = 0
+    truck_count = 0
+
+    for out in outs:
+        for detection in out:
+            if len(detection) >= 85:
+                scores = detection[5:]
+                class_id = np.argmax(scores)
+                confidence = scores[class_id]
+                if confidence > 0.3 and tscv.detector.classes[class_id] in ['car', 'truck']:
+                    center_x = int(detection[0] * width)
+                    center_y = int(detection[1] * height)
+                    w = int(detection[2] * width)
+                    h = int(detection[3] * height)
+                    x = int(center_x - w / 2)
+                    y = int(center_y - h / 2)
+                    boxes.append([x, y, w, h])
+                    confidences.append(float(confidence))
+                    class_ids.append(class_id)
+
+    indexes = cv2.dnn.NMSBoxes(boxes, confidences, 0.3, 0.4)
+    for i in range(len(boxes)):
+        if i in indexes:
+            label = str(tscv.detector.classes[class_ids[i]])
+            if label == 'car':
+                car_count += 1
+            elif label == 'truck':
+                truck_count += 1
+    return car_count, truck_count
+
+
+# Vectorized decode followed by NMS, matching what detect_objects does after net.forward
+def vectorized_postprocess(outs, width, height):
+    boxes, confidences, class_ids = tscv.decode_detections(outs, width, height)
+    if len(boxes) == 0:
+        return 0, 0
+    indexes = cv2.dnn.NMSBoxes(boxes.tolist(), confidences.tolist(), tscv.CONFIDENCE_THRESHOLD, tscv.NMS_THRESHOLD)
+    kept_class_ids = class_ids[np.asarray(indexes, dtype=int).flatten()]
+    car_count = int(np.count_nonzero(kept_class_ids == tscv.detector.classes.index('car')))
+    truck_count = int(np.count_nonzero(kept_class_ids == tscv.detector.classes.index('truck')))
+    return car_count, truck_count
+
+
+def time_per_call(func, *args, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(*args)
+    return (time.perf_counter() - start) / repeat, result
+
+
+def benchmark_postprocess(repeat=20):
+    outs = make_synthetic_outs()
+    width, height = 3840, 2160
+    legacy_time, legacy_counts = time_per_call(legacy_postprocess, outs, width, height, repeat=repeat)
+    vector_time, vector_counts = time_per_call(vectorized_postprocess, outs, width, height, repeat=repeat)
+
+    print(f"Post-processing {sum(len(out) for out in outs)} candidate rows per frame")
+    print(f"  legacy loop : {legacy_time * 1000:8.2f} ms/frame  counts={legacy_counts}")
+    print(f"  vectorized  : {vector_time * 1000:8.2f} ms/frame  counts={vector_counts}")
+    print(f"  speedup     : {legacy_time / vector_time:8.1f}x")
+    if legacy_counts != vector_counts:
+        print("  WARNING: counts differ between legacy and vectorized paths")
+
+
+# Frames/sec of detection (forward pass + post-processing) against blobFromImages batch size
+def benchmark_batching(batch_sizes=(1, 2, 4, 8), total_frames=32, frame_size=(1080, 1920)):
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 255, frame_size + (3,), dtype=np.uint8) for _ in range(total_frames)]
+    tscv.detect_objects_batch(frames[:1])  # Warm up the network once
+
+    print(f"Detection throughput over {total_frames} frames of {frame_size[1]}x{frame_size[0]}")
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        for i in range(0, total_frames, batch_size):
+            tscv.detect_objects_batch(frames[i:i + batch_size])
+        elapsed = time.perf_counter() - start
+        print(f"  batch {batch_size:3d}: {total_frames / elapsed:8.2f} frames/sec")
+
+
+# Simulate hours of signal operation on a VirtualClock and report how long it really took
+def benchmark_controller(hours=4, intersections=3):
+    async def simulate():
+        clock = tscv.VirtualClock()
+        controllers = [tscv.IntersectionController(f"Intersection {i + 1}", lambda: (30.0, 20.0), clock,
+                                                   log=lambda message: None)
+                       for i in range(intersections)]
+        for minute in range(10, hours * 60, 45):
+            clock.call_at(minute * 60 + 7.5, lambda c=controllers[minute % intersections]: c.raise_emergency(1))
+        start = time.perf_counter()
+        await tscv.run_intersections(controllers, clock, hours * 3600)
+        return time.perf_counter() - start, controllers
+
+    elapsed, controllers = asyncio.run(simulate())
+    phases = sum(len(controller.phase_history) for controller in controllers)
+    preemptions = sum(controller.preemptions for controller in controllers)
+    print(f"Simulated {hours}h x {intersections} intersections in {elapsed * 1000:.1f} ms wall time")
+    print(f"  phases: {phases}, emergency preemptions: {preemptions}")
+
+
+# Original linear scans of emergency.csv, kept as the baseline for comparison
+def legacy_check_driver_id(path, driver_id):
+    with open(path, mode='r') as file:
+        for row in csv.reader(file):
+            if row and driver_id == row[1]:
+                return True
+    return False
+
+
+def legacy_check_emergency_priority(path):
+    with open(path, mode='r') as file:
+        for row in csv.reader(file):
+            if row and row[0] in ['High', 'Medium']:
+                return True
+    return False
+
+
+# Lookups against a large emergency.csv: linear rescans vs. the cached EmergencyRegistry
+def benchmark_registry(rows=100_000, lookups=200):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'emergency.csv')
+        with open(path, mode='w', newline='') as file:
+            writer = csv.writer(file)
+            for i in range(rows):
+                writer.writerow(['Low', f'D{i}'])
+            writer.writerow(['High', 'D-last'])  # Worst case for the scan: the only active row is last
+
+        missing_id = 'unknown'
+        start = time.perf_counter()
+        for _ in range(lookups):
+            legacy_check_driver_id(path, missing_id)
+            legacy_check_emergency_priority(path)
+        legacy_time = (time.perf_counter() - start) / lookups
+
+        registry = EmergencyRegistry(path)
+        start = time.perf_counter()
+        registry.refresh()
+        load_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(lookups):
+            registry.contains(missing_id)
+            registry.has_active_emergency()
+        cached_time = (time.perf_counter() - start) / lookups
+
+        with open(path, mode='a', newline='') as file:
+            csv.writer(file).writerow(['Medium', 'D-new'])
+        start = time.perf_counter()
+        found = registry.contains('D-new')
+        append_time = time.perf_counter() - start
+
+    print(f"emergency.csv with {rows + 1} rows, driver lookup + priority check per iteration")
+    print(f"  legacy scans      : {legacy_time * 1000:9.3f} ms")
+    print(f"  registry (cached) : {cached_time * 1000:9.3f} ms  (initial load {load_time * 1000:.1f} ms)")
+    print(f"  after one append  : {append_time * 1000:9.3f} ms  (found new driver: {found})")
+
+
+# Driver-to-signal proximity: brute-force nested haversine loops vs. the SignalIndex grid
+def benchmark_proximity(signals=5000, drivers=500):
+    rng = np.random.default_rng(1)
+    signal_coordinates = list(zip(rng.uniform(9.8, 10.1, signals), rng.uniform(78.0, 78.3, signals)))
+    driver_coordinates = list(zip(rng.uniform(9.7, 10.2, drivers), rng.uniform(77.9, 78.4, drivers)))
+
+    def brute_force(lat, lon):
+        for signal_lat, signal_lon in signal_coordinates:
+            if check.haversine(lat, lon, signal_lat, signal_lon) < check.PROXIMITY_KM:
+                return signal_lat, signal_lon
+        return None
+
+    start = time.perf_counter()
+    expected = [brute_force(lat, lon) for lat, lon in driver_coordinates]
+    brute_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    signal_index = check.SignalIndex(signal_coordinates)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = [signal_index.first_within(lat, lon) for lat, lon in driver_coordinates]
+    index_time = time.perf_counter() - start
+
+    print(f"{drivers} drivers x {signals} signal posts, {sum(r is not None for r in expected)} drivers in range")
+    print(f"  brute force  : {brute_time * 1000:9.2f} ms")
+    print(f"  signal index : {index_time * 1000:9.2f} ms  (built once in {build_time * 1000:.2f} ms)")
+    print(f"  results match: {expected == actual}")
+
+
+# End-to-end latency over the localhost bus: app publishes a position -> check.py's tracker sees the
+# zone entry and publishes a preemption request -> the controller's emergency event is set
+def benchmark_bus(iterations=200):
+    async def measure(signals_file):
+        loop = asyncio.get_running_loop()
+        controller = tscv.IntersectionController("Benchmark", lambda: (30.0, 30.0), log=lambda message: None)
+        controller_bus = MessageBus()
+        tscv.connect_controller_to_bus(controller_bus, controller, loop)
+        controller_bridge = SocketBridge(controller_bus, listen_port=0).start()
+
+        check_bus = MessageBus()
+        tracker = check.ProximityTracker(signals_file=signals_file, on_enter=lambda *args: None,
+                                         on_exit=lambda *args: None, on_stay=lambda *args: None, bus=check_bus)
+        check_bus.subscribe(PositionUpdate, tracker.on_position_update)
+        check_bridge = SocketBridge(check_bus, listen_port=0, peers=[controller_bridge.port],
+                                    forward_types=(PreemptionRequest,)).start()
+
+        app_bus = MessageBus()
+        app_bridge = SocketBridge(app_bus, peers=[check_bridge.port], forward_types=(PositionUpdate,))
+
+        latencies = []
+        for i in range(iterations):
+            app_bus.publish(position_update('D1', 20.0, 78.0 + i * 1e-6))  # Far from every signal
+            await asyncio.sleep(0.002)
+            controller.emergency_event.clear()
+            start = time.perf_counter()
+            app_bus.publish(position_update('D1', 9.921, 78.116 + i * 1e-6))
+            await asyncio.wait_for(controller.emergency_event.wait(), timeout=2)
+            latencies.append(time.perf_counter() - start)
+
+        for bridge in (app_bridge, check_bridge, controller_bridge):
+            bridge.stop()
+        return sorted(latencies)
+
+    with tempfile.TemporaryDirectory() as directory:
+        signals_file = os.path.join(directory, 'signal_coor.csv')
+        with open(signals_file, mode='w') as file:
+            file.write("9.921,78.116\n")
+        latencies = asyncio.run(measure(signals_file))
+
+    print(f"Position publish -> controller preemption over localhost bus ({iterations} runs)")
+    print(f"  p50: {latencies[len(latencies) // 2] * 1000:.3f} ms")
+    print(f"  p99: {latencies[int(len(latencies) * 0.99) - 1] * 1000:.3f} ms")
+    print(f"  max: {latencies[-1] * 1000:.3f} ms")
+
+
+# Synthetic recorded tracks: ambulances driving straight through a signal at varying speeds,
+# one noisy fix per second, as {driver_id: [(t, lat, lon), ...]}
+def make_synthetic_tracks(signal, count=40, seed=2):
+    rng = np.random.default_rng(seed)
+    tracks = {}
+    for n in range(count):
+        speed = rng.uniform(6, 25)  # m/s
+        heading = rng.uniform(0, 2 * np.pi)
+        start_distance = 4000
+        offset = rng.uniform(-30, 30)  # Lateral offset of the road from the signal post, in meters
+        fixes = []
+        for t in range(int(2 * start_distance / speed)):
+            along = -start_distance + speed * t
+            north = along * np.cos(heading) - offset * np.sin(heading) + rng.normal(0, 5)
+            east = along * np.sin(heading) + offset * np.cos(heading) + rng.normal(0, 5)
+            lat = signal[0] + np.degrees(north / 6371000)
+            lon = signal[1] + np.degrees(east / (6371000 * np.cos(np.radians(signal[0]))))
+            fixes.append((float(t), float(lat), float(lon)))
+        tracks[f"A{n}"] = fixes
+    return tracks
+
+
+# Recorded tracks from a CSV of driver_id,t,lat,lon rows
+def load_tracks(path):
+    tracks = {}
+    with open(path, mode='r') as file:
+        for row in csv.reader(file):
+            if len(row) >= 4:
+                tracks.setdefault(row[0], []).append((float(row[1]), float(row[2]), float(row[3])))
+    return tracks
+
+
+# Replay tracks through the static 1.5 km / 60 s rule and the ETA predictor, reporting the green
+# time taken from cross traffic and whether the ambulance crossed while its light was green
+def benchmark_eta(tracks_file=None, static_green=60):
+    signal = (9.921, 78.116)
+    tracks = load_tracks(tracks_file) if tracks_file else make_synthetic_tracks(signal)
+    results = {'static': [0.0, 0], 'predictive': [0.0, 0]}  # [green seconds, vehicles served]
+
+    with tempfile.TemporaryDirectory() as directory:
+        signals_file = os.path.join(directory, 'signal_coor.csv')
+        with open(signals_file, mode='w') as file:
+            file.write(f"{signal[0]},{signal[1]}\n")
+
+        for driver_id, fixes in tracks.items():
+            distances = [check.haversine(lat, lon, *signal) for _, lat, lon in fixes]
+            arrival = fixes[int(np.argmin(distances))][0]
+            static_start = next((t for (t, _, _), d in zip(fixes, distances) if d < check.PROXIMITY_KM), None)
+            if static_start is None:
+                continue
+            results['static'][0] += static_green
+            results['static'][1] += static_start <= arrival <= static_start + static_green
+
+            predictor = check.EtaPredictor(signals_file)
+            window = None
+            for t, lat, lon in fixes:
+                for _, _, hold_seconds in predictor.observe(driver_id, t, lat, lon):
+                    # First request opens the window; later ones can only extend it
+                    window = (t, t + hold_seconds) if window is None else (window[0], max(window[1], t + hold_seconds))
+            if window is None:  # Predictor never fired: the radius fallback applies
+                window = (static_start, static_start + static_green)
+            results['predictive'][0] += window[1] - window[0]
+            results['predictive'][1] += window[0] <= arrival <= window[1]
+
+    print(f"Replayed {len(tracks)} ambulance tracks through one signal")
+    for name, (green, served) in results.items():
+        print(f"  {name:10s}: {green:8.1f} s green taken from cross traffic, {served}/{len(tracks)} crossed on green")
+
+
+# Cost of importing the controller module (which no longer loads the model), then model load,
+# warm-up and first-frame latency for the configured model with and without a warm-up pass
+def benchmark_startup(frame_size=(1080, 1920)):
+    command = [sys.executable, '-c', 'import TrafficSIgnalComputerVision']
+    baseline = [sys.executable, '-c', 'import cv2, numpy']
+    timings = []
+    for args in (baseline, command):
+        start = time.perf_counter()
+        subprocess.run(args, check=True)
+        timings.append(time.perf_counter() - start)
+    print(f"Interpreter + cv2/numpy: {timings[0]:.2f} s, import TrafficSIgnalComputerVision: {timings[1]:.2f} s")
+
+    frame = np.zeros(frame_size + (3,), dtype=np.uint8)
+    for warm_up in (False, True):
+        detector = tscv.Detector()
+        detector.load(warm_up=warm_up)
+        detector.forward(detector.blob([frame]))
+        print(f"  warm-up {'on ' if warm_up else 'off'}: {detector.report()}")
+
+
+# One lane filmed at 30 fps: vehicles arrive from the top every `headway` seconds, queue behind the
+# stop line while the light is red for the first half, then drive off the bottom of the frame.
+# Returns per-frame lists of (box, class_id) detections (with jitter and missed detections),
+# the true number of vehicles seen, the true queue when the light turns green and the number
+# of vehicles that left during the green half.
+def make_synthetic_lane(seconds=60, fps=30, headway=2.5, speed=250, seed=3):
+    rng = np.random.default_rng(seed)
+    height, stop_line, size, gap = 1080, 800, 60, 85
+    car_id, truck_id = tscv.detector.classes.index('car'), tscv.detector.classes.index('truck')
+    vehicles = []  # [y, class_id, moving]
+    frames, departed, queue_at_green = [], 0, 0
+    for n in range(seconds * fps):
+        t = n / fps
+        green = t >= seconds / 2
+        if n % int(headway * fps) == 0:
+            vehicles.append([-size, car_id if rng.random() < 0.8 else truck_id, True])
+        if n == seconds * fps // 2:
+            queue_at_green = sum(1 for y, _, moving in vehicles if not moving and y > 0)
+        ahead = None
+        for vehicle in vehicles:
+            limit = height * 2 if green or vehicle[0] > stop_line else stop_line
+            if ahead is not None:
+                limit = min(limit, ahead - gap)
+            step = min(speed / fps, max(0, limit - vehicle[0]))
+            vehicle[0] += step
+            vehicle[2] = step > 0.5
+            ahead = vehicle[0]
+        departed += sum(1 for y, _, _ in vehicles if y >= height)
+        vehicles = [vehicle for vehicle in vehicles if vehicle[0] < height]
+        frames.append([([500 + rng.normal(0, 2), y - size / 2 + rng.normal(0, 2), size, size], class_id)
+                       for y, class_id, _ in vehicles if y > 0 and rng.random() > 0.05])
+    total = int(np.ceil(seconds * fps / int(headway * fps)))
+    return frames, total, queue_at_green, departed
+
+
+# Unique counts, queue length and discharge rate from the VehicleTracker at several detection
+# intervals, next to the per-frame average that process_video reports
+def benchmark_tracking(fps=30):
+    frames, total, queue_at_green, departed = make_synthetic_lane(fps=fps)
+    half = len(frames) // 2
+    detections = sum(len(frame) for frame in frames)
+    print(f"Synthetic lane: {total} vehicles, {queue_at_green} queued at green, {departed} left on green "
+          f"({departed / (half / fps):.2f} vehicles/sec)")
+    print(f"  per-frame average count: {detections // len(frames)}")
+    for detect_every in (1, 3, 6):
+        tracker = tscv.VehicleTracker()
+        windows = []
+        start = time.perf_counter()
+        for n in range(0, len(frames), detect_every):
+            if n // half > len(windows):
+                windows.append(tracker.window_stats())
+            boxes = [box for box, _ in frames[n]]
+            tracker.update(boxes, [class_id for _, class_id in frames[n]], n / fps, 1080)
+        windows.append(tracker.window_stats())
+        elapsed = time.perf_counter() - start
+        red, green = windows
+        print(f"  detect every {detect_every}: {len(range(0, len(frames), detect_every)):5d} DNN calls, "
+              f"{red['unique_vehicles'] + green['unique_vehicles']} unique, queue at green {red['queue_length']}, "
+              f"discharge {green['discharge_rate']:.2f} vehicles/sec, tracker {elapsed * 1000:.1f} ms")
+
+
+# Network input pixels and detection time per frame on the full frame vs. an ROI crop covering the
+# lower-left quarter of a 1080p view. With TRAFFIC_DETECTOR=stub the stub's delay scales with the blob
+# area, so the time column shows the expected saving; with the real model it is measured.
+def benchmark_roi(frames=20, stub_latency=0.05):
+    frame = np.random.default_rng(0).integers(0, 255, (1080, 1920, 3), dtype=np.uint8)
+    roi = tscv.CameraROI([('left', [[0.0, 0.5], [0.25, 0.5], [0.25, 1.0], [0.0, 1.0]]),
+                          ('right', [[0.25, 0.5], [0.5, 0.5], [0.5, 1.0], [0.25, 1.0]])])
+    if isinstance(tscv.detector.net, tscv.StubNetwork):
+        tscv.detector.net.latency = stub_latency
+    tscv.detect_objects(frame, draw=False)  # Warm up the network once
+
+    print(f"Detection on {frames} frames of 1920x1080, ROI = lower-left quarter")
+    for name, region in (('full frame', None), ('ROI crop', roi)):
+        blob = tscv.make_blob(frame, region)
+        start = time.perf_counter()
+        for _ in range(frames):
+            tscv.detect_objects(frame, draw=False, roi=region)
+        elapsed = (time.perf_counter() - start) / frames
+        print(f"  {name:10s}: input {blob.shape[3]}x{blob.shape[2]} ({blob.shape[2] * blob.shape[3]:6d} px), "
+              f"{elapsed * 1000:7.2f} ms/frame")
+
+
+BENCHMARKS = {
+    'postprocess': benchmark_postprocess,
+    'batching': benchmark_batching,
+    'controller': benchmark_controller,
+    'registry': benchmark_registry,
+    'proximity': benchmark_proximity,
+    'bus': benchmark_bus,
+    'eta': benchmark_eta,
+    'startup': benchmark_startup,
+    'tracking': benchmark_tracking,
+    'roi': benchmark_roi,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name}. Available: {', '.join(BENCHMARKS)}")
+            continue
+        print(f"=== {name} ===")
+        BENCHMARKS[name]()
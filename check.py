@@ -1,10 +1,19 @@
 import csv
 import math
+import os
 import re
+import threading
+from collections import defaultdict, deque
+import numpy as np
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import time
 
+from coordinate_log import read_latest_rows
+from message_bus import (BUS_PORTS, MessageBus, PositionUpdate, PreemptionRequest, SocketBridge,
+                         preemption_request)
+from preemption_store import PreemptionStore
+
 # Haversine formula to calculate the distance between two coordinates
 def haversine(lat1, lon1, lat2, lon2):
     R = 6371  # Earth radius in kilometers
@@ -15,6 +24,195 @@ def haversine(lat1, lon1, lat2, lon2):
     c = 2 * math.asin(math.sqrt(a))
     return R * c  # Distance in kilometers
 
+# Vectorized haversine: distance in km from one point to arrays of points
+def haversine_np(lat1, lon1, lat2, lon2):
+    R = 6371
+    lat1, lon1 = math.radians(lat1), math.radians(lon1)
+    lat2, lon2 = np.radians(lat2), np.radians(lon2)
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arcsin(np.sqrt(a))
+    return R * c
+
+# Distance below which a driver counts as near a signal post
+PROXIMITY_KM = 1.5
+
+# Convert lat/lon in degrees to points on the unit sphere
+def to_unit_vectors(lat, lon):
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+# Spatial index over signal posts: a uniform 3D grid on unit-sphere coordinates with cells one
+# search radius wide, so a radius query only has to look at the 27 cells around the driver.
+# Candidates from those cells are then checked with the exact vectorized haversine.
+class SignalIndex:
+    def __init__(self, signal_coordinates, radius_km=PROXIMITY_KM):
+        self.radius_km = radius_km
+        self.coordinates = np.array(signal_coordinates, dtype=float).reshape(-1, 2)
+        # Chord length matching the radius, padded slightly so the grid never misses a boundary case
+        self.cell_size = 2 * math.sin(radius_km / (2 * 6371)) * 1.001
+        self.cells = defaultdict(list)
+        for index, key in enumerate(self.cell_keys(to_unit_vectors(self.coordinates[:, 0], self.coordinates[:, 1]))):
+            self.cells[key].append(index)
+        self.cells = {key: np.array(indexes) for key, indexes in self.cells.items()}
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def cell_keys(self, points):
+        return [tuple(key) for key in np.floor(points / self.cell_size).astype(int).tolist()]
+
+    # Indexes (in file order) of all signal posts strictly within the radius of (lat, lon)
+    def query_radius(self, lat, lon):
+        cx, cy, cz = self.cell_keys(to_unit_vectors(np.array([lat]), np.array([lon])))[0]
+        buckets = [self.cells.get((cx + dx, cy + dy, cz + dz))
+                   for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)]
+        buckets = [bucket for bucket in buckets if bucket is not None]
+        if not buckets:
+            return np.empty(0, dtype=int)
+        candidates = np.sort(np.concatenate(buckets))
+        distances = haversine_np(lat, lon, self.coordinates[candidates, 0], self.coordinates[candidates, 1])
+        return candidates[distances < self.radius_km]
+
+    # First signal post in file order within the radius, matching the original loop's choice
+    def first_within(self, lat, lon):
+        matches = self.query_radius(lat, lon)
+        if len(matches) == 0:
+            return None
+        signal_lat, signal_lon = self.coordinates[matches[0]]
+        return float(signal_lat), float(signal_lon)
+
+signal_index_cache = {}  # (filename, radius_km) -> (mtime_ns, SignalIndex)
+
+# Load signal_coor.csv into a SignalIndex once, rebuilding only if the file changes
+def load_signal_index(filename, radius_km=PROXIMITY_KM):
+    try:
+        mtime = os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        print(f"{filename} not found.")
+        return None
+    cached = signal_index_cache.get((filename, radius_km))
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, SignalIndex(read_signal_coordinates_from_csv(filename), radius_km))
+        signal_index_cache[(filename, radius_km)] = cached
+    return cached[1]
+
+# Predictive preemption: signal posts within LOOKAHEAD_KM that lie ahead on the driver's
+# heading (within ROUTE_TOLERANCE_M or ROUTE_ANGLE_TOLERANCE_DEG of it) are preempted PREEMPT_LEAD_SECONDS before the
+# predicted arrival and held green until CROSSING_MARGIN_SECONDS after it
+PREDICTIVE = True
+LOOKAHEAD_KM = 3.0
+PREEMPT_LEAD_SECONDS = 15
+CROSSING_MARGIN_SECONDS = 5
+ROUTE_TOLERANCE_M = 150
+ROUTE_ANGLE_TOLERANCE_DEG = 20  # Heading estimates from noisy fixes wobble by several degrees
+MIN_SPEED_MPS = 1.0  # Below this the driver is treated as stopped and no ETA is predicted
+
+# Initial bearing in degrees from point 1 to point 2
+def bearing_deg(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    dlon = lon2 - lon1
+    x = math.sin(dlon) * math.cos(lat2)
+    y = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(dlon)
+    return math.degrees(math.atan2(x, y)) % 360
+
+# Motion model for one driver built from its most recent timestamped fixes
+class MotionModel:
+    def __init__(self, history=5):
+        self.fixes = deque(maxlen=history)  # (timestamp, lat, lon)
+
+    def add(self, timestamp, lat, lon):
+        if self.fixes and timestamp <= self.fixes[-1][0]:
+            return  # Out-of-order or duplicate fix
+        self.fixes.append((timestamp, lat, lon))
+
+    # (speed in m/s, heading in degrees) over the history window, or None with too few fixes
+    def velocity(self):
+        if len(self.fixes) < 2:
+            return None
+        t0, lat0, lon0 = self.fixes[0]
+        t1, lat1, lon1 = self.fixes[-1]
+        if t1 <= t0:
+            return None
+        speed = haversine(lat0, lon0, lat1, lon1) * 1000 / (t1 - t0)
+        return speed, bearing_deg(lat0, lon0, lat1, lon1)
+
+    # Seconds until the driver reaches the point, or None if stopped, moving away or off route
+    def eta_to(self, lat, lon, route_tolerance_m=ROUTE_TOLERANCE_M):
+        velocity = self.velocity()
+        if velocity is None or velocity[0] < MIN_SPEED_MPS:
+            return None
+        speed, heading = velocity
+        _, current_lat, current_lon = self.fixes[-1]
+        distance = haversine(current_lat, current_lon, lat, lon) * 1000
+        angle = math.radians(bearing_deg(current_lat, current_lon, lat, lon) - heading)
+        along_track = distance * math.cos(angle)
+        cross_track = abs(distance * math.sin(angle))
+        off_route = (cross_track > route_tolerance_m
+                     and cross_track > along_track * math.tan(math.radians(ROUTE_ANGLE_TOLERANCE_DEG)))
+        if along_track <= 0 or off_route:
+            return None
+        return along_track / speed
+
+# Keeps a MotionModel per driver and decides when each signal ahead should be preempted.
+# Once a signal is preempted, later fixes that push the predicted crossing past the requested
+# window produce an extension instead of a new preemption.
+class EtaPredictor:
+    def __init__(self, signals_file='signal_coor.csv', lookahead_km=LOOKAHEAD_KM, lead_seconds=PREEMPT_LEAD_SECONDS,
+                 margin_seconds=CROSSING_MARGIN_SECONDS, history=8, extend_threshold=1.0):
+        self.signals_file = signals_file
+        self.lookahead_km = lookahead_km
+        self.lead_seconds = lead_seconds
+        self.margin_seconds = margin_seconds
+        self.history = history
+        self.extend_threshold = extend_threshold  # Seconds a window must grow by before re-requesting
+        self.models = {}  # driver_id -> MotionModel
+        self.requested = defaultdict(dict)  # driver_id -> {signal still ahead: requested green end time}
+        self.ahead = {}  # driver_id -> signals with a current ETA prediction
+
+    # Feed one fix; returns [(signal, eta, hold_seconds)] for signals to preempt (or extend) now
+    def observe(self, driver_id, timestamp, lat, lon):
+        model = self.models.setdefault(driver_id, MotionModel(self.history))
+        model.add(timestamp, lat, lon)
+        signal_index = load_signal_index(self.signals_file, self.lookahead_km)
+        if not signal_index:
+            return []
+
+        requested = self.requested[driver_id]
+        ahead = set()
+        predictions = []
+        for index in signal_index.query_radius(lat, lon):
+            signal = tuple(float(value) for value in signal_index.coordinates[index])
+            eta = model.eta_to(*signal)
+            if eta is None:
+                continue
+            ahead.add(signal)
+            green_until = timestamp + eta + self.margin_seconds
+            if signal in requested:
+                if green_until > requested[signal] + self.extend_threshold:
+                    requested[signal] = green_until
+                    predictions.append((signal, eta, green_until - timestamp))
+            elif eta <= self.lead_seconds:
+                requested[signal] = green_until
+                predictions.append((signal, eta, green_until - timestamp))
+        self.ahead[driver_id] = ahead
+        # Forget signals the driver has passed so a later approach triggers again
+        for signal in list(requested):
+            if signal not in ahead:
+                del requested[signal]
+        return predictions
+
+    # Current direction of travel in degrees, or None if unknown
+    def heading_of(self, driver_id):
+        model = self.models.get(driver_id)
+        velocity = model.velocity() if model is not None else None
+        return velocity[1] if velocity is not None else None
+
+    # True if the predictor is handling this signal for the driver (it has an ETA or already preempted)
+    def covers(self, driver_id, signal):
+        return signal in self.requested.get(driver_id, ()) or signal in self.ahead.get(driver_id, ())
+
 # Function to parse coordinates from the string format "(lat, lon)"
 def parse_coordinates(coordinate_str):
     match = re.match(r"\(([^,]+), ([^,]+)\)", coordinate_str)
@@ -24,25 +222,22 @@ def parse_coordinates(coordinate_str):
         return lat, lon
     return None
 
-# Function to read driver coordinates from coordinates.csv
+# Function to read driver coordinates from coordinates.csv (latest row per driver)
 def read_driver_coordinates_from_csv(filename):
     coordinates = []
     try:
-        with open(filename, mode='r') as file:
-            reader = csv.reader(file)
-            for row in reader:
-                if row:
-                    driver_id = row[0].strip()
-                    coordinate_str = row[1].strip('"').strip()
-                    parsed_coordinates = parse_coordinates(coordinate_str)
-                    if parsed_coordinates:
-                        lat, lon = parsed_coordinates
-                        coordinates.append((driver_id, lat, lon))
-                        print(f"Driver ID: {driver_id}, Coordinates: {lat}, {lon}")
-                    else:
-                        print(f"Failed to parse coordinates: {row[1]}")
+        latest_rows = read_latest_rows(filename)
     except FileNotFoundError:
         print(f"{filename} not found.")
+        return coordinates
+    for driver_id, coordinate_str in latest_rows.items():
+        parsed_coordinates = parse_coordinates(coordinate_str.strip('"').strip())
+        if parsed_coordinates:
+            lat, lon = parsed_coordinates
+            coordinates.append((driver_id, lat, lon))
+            print(f"Driver ID: {driver_id}, Coordinates: {lat}, {lon}")
+        else:
+            print(f"Failed to parse coordinates: {coordinate_str}")
     return coordinates
 
 # Function to read signal coordinates from signal_coor.csv
@@ -61,44 +256,185 @@ def read_signal_coordinates_from_csv(filename):
         print(f"{filename} not found.")
     return coordinates
 
-# Write output to CSV file
-def write_to_csv(signal_lat, signal_lon):
-    with open('output.csv', mode='a', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow([(signal_lat, signal_lon), 'high'])
+# One active record per signal in output.csv; history goes to preemption_history.log
+preemption_store = PreemptionStore('output.csv')
+
+# Write output to CSV file (starts or refreshes the signal's preemption)
+def write_to_csv(signal_lat, signal_lon, driver_id=None):
+    preemption_store.preempt(signal_lat, signal_lon, driver_id)
 
 # Check if any coordinate in driver_coordinates is within 1.5 km of any coordinate in signal_coor.csv
 def check_distance():
     driver_coordinates = read_driver_coordinates_from_csv('coordinates.csv')
-    signal_coordinates = read_signal_coordinates_from_csv('signal_coor.csv')
+    signal_index = load_signal_index('signal_coor.csv')
 
-    if not driver_coordinates or not signal_coordinates:
+    if not driver_coordinates or not signal_index:
         print("No coordinates found to compare.")
         return
 
     for driver_id, driver_lat, driver_lon in driver_coordinates:
-        found_near_signal = False
-        for signal_lat, signal_lon in signal_coordinates:
-            distance = haversine(driver_lat, driver_lon, signal_lat, signal_lon)
-            if distance < 1.5:
-                print(f"Driver {driver_id}: high, Signal Coordinates: ({signal_lat}, {signal_lon})")
-                write_to_csv(signal_lat, signal_lon)  # Write to CSV file
-                found_near_signal = True
-                break  # Stop checking further signals once a "high" is found
-
-        if not found_near_signal:
+        nearby_signal = signal_index.first_within(driver_lat, driver_lon)
+        if nearby_signal is not None:
+            signal_lat, signal_lon = nearby_signal
+            print(f"Driver {driver_id}: high, Signal Coordinates: ({signal_lat}, {signal_lon})")
+            write_to_csv(signal_lat, signal_lon, driver_id)  # Write to CSV file
+        else:
             print(f"Driver {driver_id} is not close to any signal.")
 
+# Incremental proximity checker: remembers each driver's last position and signal zone,
+# re-evaluates only drivers whose position changed, and reports only zone enter/exit transitions.
+class ProximityTracker:
+    def __init__(self, coordinates_file='coordinates.csv', signals_file='signal_coor.csv',
+                 on_enter=None, on_exit=None, bus=None, predictor=None, on_predict=None, on_stay=None):
+        self.coordinates_file = coordinates_file
+        self.signals_file = signals_file
+        self.on_enter = on_enter or self.default_enter
+        self.on_exit = on_exit or self.default_exit
+        self.on_predict = on_predict or self.default_predict
+        self.on_stay = on_stay or self.default_stay
+        self.bus = bus  # When set, zone entries are also published as PreemptionRequest messages
+        self.predictor = predictor  # Optional EtaPredictor for just-in-time preemption
+        self.lock = threading.Lock()
+        self.last_positions = {}  # driver_id -> (lat, lon)
+        self.zones = {}  # driver_id -> (signal_lat, signal_lon) the driver is near, or None
+        self.metrics = {'events_received': 0, 'evaluations': 0, 'drivers_evaluated': 0, 'transitions': 0}
+
+    def default_enter(self, driver_id, signal):
+        print(f"Driver {driver_id}: high, entered zone of Signal Coordinates: {signal}")
+        write_to_csv(*signal, driver_id)
+
+    def default_predict(self, driver_id, signal, eta, hold_seconds):
+        print(f"Driver {driver_id}: high, predicted at Signal Coordinates: {signal} in {eta:.1f}s "
+              f"(hold green {hold_seconds:.1f}s)")
+        write_to_csv(*signal, driver_id)
+
+    # A new fix inside the same zone keeps the preemption from expiring while the driver approaches
+    def default_stay(self, driver_id, signal):
+        preemption_store.preempt(*signal, driver_id)
+
+    def default_exit(self, driver_id, signal):
+        print(f"Driver {driver_id} left zone of Signal Coordinates: {signal}")
+        preemption_store.release(*signal, driver_id)
+
+    # Apply one set of (driver_id, lat, lon) positions; returns the transitions it produced
+    def apply_positions(self, positions, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        signal_index = load_signal_index(self.signals_file)
+        transitions = []
+        predictions = []
+        stays = []
+        with self.lock:
+            self.metrics['evaluations'] += 1
+            for driver_id, lat, lon in positions:
+                if self.last_positions.get(driver_id) == (lat, lon):
+                    continue
+                self.last_positions[driver_id] = (lat, lon)
+                self.metrics['drivers_evaluated'] += 1
+                if self.predictor is not None:
+                    predictions.extend((driver_id,) + prediction
+                                       for prediction in self.predictor.observe(driver_id, timestamp, lat, lon))
+
+                zone = signal_index.first_within(lat, lon) if signal_index else None
+                previous = self.zones.get(driver_id)
+                if zone == previous:
+                    if zone is not None:
+                        stays.append((driver_id, zone))
+                    continue
+                self.zones[driver_id] = zone
+                if previous is not None:
+                    transitions.append(('exit', driver_id, previous))
+                if zone is not None:
+                    transitions.append(('enter', driver_id, zone))
+            self.metrics['transitions'] += len(transitions)
+
+        for driver_id, signal, eta, hold_seconds in predictions:
+            self.on_predict(driver_id, signal, eta, hold_seconds)
+            if self.bus is not None:
+                self.bus.publish(preemption_request(*signal, driver_id, eta=eta, hold_seconds=hold_seconds,
+                                                    heading=self.predictor.heading_of(driver_id)))
+        for driver_id, signal in stays:
+            self.on_stay(driver_id, signal)
+        for kind, driver_id, signal in transitions:
+            (self.on_enter if kind == 'enter' else self.on_exit)(driver_id, signal)
+            # The radius trigger is only a fallback for signals the predictor cannot time
+            if kind == 'enter' and self.bus is not None and not (
+                    self.predictor is not None and self.predictor.covers(driver_id, signal)):
+                heading = self.predictor.heading_of(driver_id) if self.predictor is not None else None
+                self.bus.publish(preemption_request(*signal, driver_id, heading=heading))
+        return transitions + [('predict', driver_id, signal) for driver_id, signal, _, _ in predictions]
+
+    # Bus subscriber: evaluate a single position as soon as it is published
+    def on_position_update(self, message):
+        self.apply_positions([(message.driver_id, message.lat, message.lon)], message.sent_at)
+
+    def update(self):
+        try:
+            latest_rows = read_latest_rows(self.coordinates_file)
+        except FileNotFoundError:
+            print(f"{self.coordinates_file} not found.")
+            return []
+        positions = []
+        for driver_id, coordinate_str in latest_rows.items():
+            parsed_coordinates = parse_coordinates(coordinate_str.strip('"').strip())
+            if parsed_coordinates:
+                positions.append((driver_id,) + parsed_coordinates)
+        return self.apply_positions(positions)
+
+    def metrics_summary(self):
+        return (f"events received: {self.metrics['events_received']}, evaluations: {self.metrics['evaluations']}, "
+                f"drivers evaluated: {self.metrics['drivers_evaluated']}, transitions: {self.metrics['transitions']}")
+
+# Receive positions over the message bus and publish preemptions to the controller
+# (requires INCREMENTAL); the watchdog on coordinates.csv stays active as a fallback
+USE_MESSAGE_BUS = True
+
+# Re-check only changed drivers and coalesce bursts of watchdog events within this window
+INCREMENTAL = True
+DEBOUNCE_SECONDS = 0.2
+
 # Watchdog event handler to monitor changes in coordinates.csv
 class CSVChangeHandler(FileSystemEventHandler):
+    def __init__(self, tracker=None, debounce=DEBOUNCE_SECONDS):
+        super().__init__()
+        self.tracker = tracker
+        self.debounce = debounce
+        self.timer = None
+        self.timer_lock = threading.Lock()
+
     def on_modified(self, event):
-        if event.src_path.endswith("coordinates.csv"):
+        if not event.src_path.endswith("coordinates.csv"):
+            return
+        if self.tracker is None:
             print("\ncoordinates.csv updated. Re-running check_distance()...\n")
             check_distance()
+            return
+
+        self.tracker.metrics['events_received'] += 1
+        with self.timer_lock:
+            if self.timer is None:
+                # The first event of a burst schedules one evaluation; later ones are absorbed
+                self.timer = threading.Timer(self.debounce, self.run_update)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def run_update(self):
+        with self.timer_lock:
+            self.timer = None
+        self.tracker.update()
+        print(self.tracker.metrics_summary())
 
 if __name__ == "__main__":
     # Initialize Watchdog observer to monitor changes in the directory
-    event_handler = CSVChangeHandler()
+    tracker = None
+    bus_bridge = None
+    if INCREMENTAL:
+        bus = MessageBus() if USE_MESSAGE_BUS else None
+        tracker = ProximityTracker(bus=bus, predictor=EtaPredictor() if PREDICTIVE else None)
+        if bus is not None:
+            bus.subscribe(PositionUpdate, tracker.on_position_update)
+            bus_bridge = SocketBridge(bus, listen_port=BUS_PORTS['proximity'], peers=[BUS_PORTS['controller']],
+                                      forward_types=(PreemptionRequest,)).start()
+    event_handler = CSVChangeHandler(tracker)
     observer = Observer()
     observer.schedule(event_handler, path=".", recursive=False)  # Monitor current directory
 
@@ -106,11 +442,17 @@ if __name__ == "__main__":
 
     try:
         print("Monitoring coordinates.csv for changes...\n")
-        check_distance()  # Run the function initially
+        if tracker is not None:
+            tracker.update()  # Establish each driver's starting zone
+        else:
+            check_distance()  # Run the function initially
         while True:
             time.sleep(1)  # Keep the script running
+            preemption_store.expire()  # Drop preemptions nobody refreshed within their TTL
     except KeyboardInterrupt:
         observer.stop()  # Stop observer on interrupt
+        if bus_bridge is not None:
+            bus_bridge.stop()
         print("Stopped monitoring.")
     
     observer.join()
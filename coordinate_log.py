@@ -0,0 +1,74 @@
+import csv
+import io
+import os
+
+# Append-only store for driver positions in coordinates.csv. Every update is a single
+# appended row (O(1) I/O); the latest row per driver wins. The file is compacted every
+# `compact_every` appends by writing a temp file and atomically swapping it in, so a
+# concurrent reader such as check.py never sees a truncated file.
+class CoordinateLog:
+    def __init__(self, path='coordinates.csv', compact_every=1000):
+        self.path = path
+        self.compact_every = compact_every
+        self.appends_since_compaction = 0
+
+    def append(self, driver_id, live_coordinates):
+        self.append_many([(driver_id, live_coordinates)])
+
+    # Append several (driver_id, coordinates) rows with a single open/write
+    def append_many(self, rows):
+        with open(self.path, mode='a', newline='') as file:
+            csv.writer(file).writerows([[driver_id, live_coordinates] for driver_id, live_coordinates in rows])
+        self.appends_since_compaction += len(rows)
+        if self.compact_every and self.appends_since_compaction >= self.compact_every:
+            self.compact()
+
+    # Rewrite the log with only the latest row per driver
+    def compact(self):
+        try:
+            with open(self.path, mode='rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return
+        complete = data.rfind(b'\n') + 1
+        latest = parse_latest_rows(data[:complete].decode('utf-8', errors='replace'))
+
+        temp_path = f"{self.path}.compact"
+        with open(temp_path, mode='w', newline='') as file:
+            writer = csv.writer(file)
+            for driver_id, coordinate_str in latest.items():
+                writer.writerow([driver_id, coordinate_str])
+            # Carry over anything appended while we were compacting
+            with open(self.path, mode='rb') as source:
+                source.seek(complete)
+                tail = source.read()
+            file.write(tail.decode('utf-8', errors='replace'))
+        try:
+            os.replace(temp_path, self.path)
+        except PermissionError:
+            # A reader holds the file open (Windows); try again after the next batch of appends
+            os.remove(temp_path)
+            return
+        self.appends_since_compaction = 0
+
+
+# Map each driver ID to the coordinate string of its latest row, in order of last update
+def parse_latest_rows(text):
+    latest = {}
+    for row in csv.reader(io.StringIO(text)):
+        if len(row) >= 2:
+            driver_id = row[0].strip()
+            latest.pop(driver_id, None)
+            latest[driver_id] = row[1]
+    return latest
+
+
+# Read the latest position row per driver, ignoring a half-written final row
+def read_latest_rows(path='coordinates.csv'):
+    with open(path, mode='rb') as file:
+        data = file.read()
+    complete = data.rfind(b'\n') + 1
+    return parse_latest_rows(data[:complete].decode('utf-8', errors='replace'))
+
+
+coordinate_log = CoordinateLog()
@@ -0,0 +1,103 @@
+import csv
+import io
+import os
+import threading
+
+# Emergency levels that make a signal give way
+ACTIVE_LEVELS = ('High', 'Medium')
+
+# Bytes at each end of the parsed prefix that are compared to detect a rewritten file
+PREFIX_CHECK_BYTES = 4096
+
+
+# In-memory index over emergency.csv shared by EmergencyApp and the signal controller.
+# The file is only re-read when its mtime or size changes. While the already parsed prefix is
+# unchanged (same first and last bytes), only the appended rows are parsed; a file that was
+# truncated or rewritten (e.g. an operator clearing an emergency) is parsed again from the start.
+class EmergencyRegistry:
+    def __init__(self, path='emergency.csv'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.levels = {}  # driver_id -> level of the driver's latest row
+        self.active_count = 0  # Number of High/Medium rows in the file
+        self.rows = []  # (level, driver_id) in file order, for consumers that follow new registrations
+        self.generation = 0  # Bumped whenever the index is rebuilt from the start of the file
+        self.signature = None  # (mtime_ns, size) of the file when last loaded
+        self.offset = 0  # Byte offset just past the last complete row parsed
+        self.prefix = b''  # fingerprint() of the bytes before offset
+        self.reloads = 0
+
+    def clear(self):
+        self.levels = {}
+        self.active_count = 0
+        self.rows = []
+        self.generation += 1
+        self.offset = 0
+        self.prefix = b''
+
+    # First and last PREFIX_CHECK_BYTES of the file's first `end` bytes
+    def fingerprint(self, file, end):
+        file.seek(0)
+        head = file.read(min(end, PREFIX_CHECK_BYTES))
+        file.seek(max(0, end - PREFIX_CHECK_BYTES))
+        return head + file.read(end - max(0, end - PREFIX_CHECK_BYTES))
+
+    def parse_rows(self, text):
+        for row in csv.reader(io.StringIO(text)):
+            if len(row) < 2:
+                continue
+            level, driver_id = row[0], row[1]
+            self.levels[driver_id] = level
+            self.rows.append((level, driver_id))
+            if level in ACTIVE_LEVELS:
+                self.active_count += 1
+
+    # Bring the index up to date with the file; cheap (one stat call) when nothing changed
+    def refresh(self):
+        with self.lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                print(f"{self.path} not found.")
+                self.clear()
+                self.signature = None
+                return
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if signature == self.signature:
+                return
+
+            with open(self.path, mode='rb') as file:
+                if stat.st_size < self.offset or self.fingerprint(file, self.offset) != self.prefix:
+                    self.clear()  # File was truncated or rewritten, parse it again from the start
+                file.seek(self.offset)
+                data = file.read()
+                complete = data.rfind(b'\n') + 1  # Leave a half-written last row for the next refresh
+                self.parse_rows(data[:complete].decode('utf-8', errors='replace'))
+                self.offset += complete
+                self.prefix = self.fingerprint(file, self.offset)
+            self.signature = signature if complete == len(data) else None
+            self.reloads += 1
+
+    def contains(self, driver_id):
+        self.refresh()
+        return driver_id in self.levels
+
+    def level_of(self, driver_id):
+        self.refresh()
+        return self.levels.get(driver_id)
+
+    def has_active_emergency(self):
+        self.refresh()
+        return self.active_count > 0
+
+    # Rows appended since `cursor`, plus the cursor to pass next time. A None cursor (or one from
+    # before the file was rewritten) starts at the current end, so old rows are never replayed.
+    def rows_since(self, cursor=None):
+        self.refresh()
+        with self.lock:
+            if cursor is None or cursor[0] != self.generation:
+                return [], (self.generation, len(self.rows))
+            return self.rows[cursor[1]:], (self.generation, len(self.rows))
+
+
+registry = EmergencyRegistry()
@@ -0,0 +1,151 @@
+import csv
+import json
+import socket
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+from coordinate_log import coordinate_log
+
+# Typed messages exchanged by EmergencyApp, check.py and the signal controller
+PositionUpdate = namedtuple('PositionUpdate', ['driver_id', 'lat', 'lon', 'sent_at'])
+EmergencyRegistration = namedtuple('EmergencyRegistration', ['level', 'driver_id', 'sent_at'])
+# eta/hold_seconds are set for predictive preemptions: seconds until the vehicle reaches the
+# signal and how long the signal should stay green for it. heading is the vehicle's direction
+# of travel in degrees, used by the controller to pick the approach to serve.
+PreemptionRequest = namedtuple('PreemptionRequest',
+                               ['signal_lat', 'signal_lon', 'level', 'driver_id', 'sent_at', 'eta', 'hold_seconds',
+                                'heading'],
+                               defaults=(None, None, None))
+
+MESSAGE_TYPES = {message_type.__name__: message_type
+                 for message_type in (PositionUpdate, EmergencyRegistration, PreemptionRequest)}
+
+# Local UDP ports each program listens on for bus messages
+BUS_HOST = '127.0.0.1'
+BUS_PORTS = {'proximity': 50510, 'controller': 50511}
+
+
+# In-process publish/subscribe bus. Subscribers are called synchronously on publish,
+# keyed by message type.
+class MessageBus:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = defaultdict(list)
+
+    def subscribe(self, message_type, callback):
+        with self.lock:
+            self.subscribers[message_type].append(callback)
+
+    def publish(self, message):
+        with self.lock:
+            callbacks = list(self.subscribers[type(message)])
+        for callback in callbacks:
+            callback(message)
+
+
+def encode_message(message):
+    return json.dumps({'type': type(message).__name__, 'fields': list(message)}).encode('utf-8')
+
+
+def decode_message(data):
+    payload = json.loads(data.decode('utf-8'))
+    return MESSAGE_TYPES[payload['type']](*payload['fields'])
+
+
+# Links a local MessageBus to other programs over localhost UDP: messages of the forwarded
+# types published locally are sent to every peer port, and datagrams received on
+# listen_port are published on the local bus (and not forwarded again).
+class SocketBridge:
+    def __init__(self, bus, listen_port=None, peers=(), forward_types=()):
+        self.bus = bus
+        self.peers = [(BUS_HOST, port) for port in peers]  # Extend later with add_peer()
+        self.remote = threading.local()
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver = None
+        self.port = None
+        self.running = False
+        for message_type in forward_types:
+            bus.subscribe(message_type, self.forward)
+        if listen_port is not None:
+            self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.receiver.bind((BUS_HOST, listen_port))
+            self.receiver.settimeout(0.5)
+            self.port = self.receiver.getsockname()[1]  # Resolved port when listen_port is 0
+
+    def add_peer(self, port):
+        self.peers.append((BUS_HOST, port))
+
+    def forward(self, message):
+        if message is getattr(self.remote, 'message', None):
+            return  # Just received from a peer; don't echo it back out
+        data = encode_message(message)
+        for peer in self.peers:
+            self.sender.sendto(data, peer)
+
+    def listen(self):
+        while self.running:
+            try:
+                data, _ = self.receiver.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                message = decode_message(data)
+            except (ValueError, KeyError, TypeError):
+                print("Ignoring malformed bus message")
+                continue
+            self.remote.message = message
+            try:
+                self.bus.publish(message)
+            finally:
+                self.remote.message = None
+
+    def start(self):
+        if self.receiver is not None:
+            self.running = True
+            threading.Thread(target=self.listen, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.receiver is not None:
+            self.receiver.close()
+        self.sender.close()
+
+
+# Keeps the existing CSV files up to date from bus traffic so tools that still read
+# coordinates.csv, emergency.csv or output.csv keep working
+class CsvCompatAdapter:
+    def __init__(self, bus, write_positions=True, write_emergencies=True, preemption_store=None):
+        if write_positions:
+            bus.subscribe(PositionUpdate, self.on_position)
+        if write_emergencies:
+            bus.subscribe(EmergencyRegistration, self.on_emergency)
+        self.preemption_store = preemption_store
+        if preemption_store is not None:
+            bus.subscribe(PreemptionRequest, self.on_preemption)
+
+    def on_position(self, message):
+        coordinate_log.append(message.driver_id, (message.lat, message.lon))
+
+    def on_emergency(self, message):
+        with open('emergency.csv', mode='a', newline='') as file:
+            csv.writer(file).writerow([message.level, message.driver_id])
+
+    def on_preemption(self, message):
+        self.preemption_store.preempt(message.signal_lat, message.signal_lon, message.driver_id, message.level)
+
+
+# sent_at defaults to now; pass the fix time when publishing buffered fixes
+def position_update(driver_id, lat, lon, sent_at=None):
+    return PositionUpdate(driver_id, lat, lon, time.time() if sent_at is None else sent_at)
+
+
+def emergency_registration(level, driver_id):
+    return EmergencyRegistration(level, driver_id, time.time())
+
+
+def preemption_request(signal_lat, signal_lon, driver_id, level='high', eta=None, hold_seconds=None, heading=None):
+    return PreemptionRequest(signal_lat, signal_lon, level, driver_id, time.time(), eta, hold_seconds, heading)
@@ -0,0 +1,130 @@
+import csv
+import logging
+import logging.handlers
+import os
+import re
+import threading
+import time
+
+# How long a preemption stays active without being refreshed by a nearby driver
+DEFAULT_TTL_SECONDS = 60
+
+
+# Holds one active preemption record per signal post. output.csv is rewritten (atomically) with
+# only the active set, so consumers read a handful of rows instead of an ever-growing file.
+# Starts, releases and expiries are recorded in a rotating history log.
+class PreemptionStore:
+    def __init__(self, path='output.csv', history_path='preemption_history.log', ttl=DEFAULT_TTL_SECONDS,
+                 max_history_bytes=1_000_000, history_backups=5):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.active = {}  # (signal_lat, signal_lon) -> {'level', 'drivers', 'expires_at', 'written_expiry'}
+        self.dirty = False  # output.csv is behind the active set (a rewrite failed); retried on the next write
+
+        self.history = logging.getLogger(f"preemption.history.{os.path.abspath(history_path)}")
+        self.history.setLevel(logging.INFO)
+        self.history.propagate = False
+        if not self.history.handlers:
+            handler = logging.handlers.RotatingFileHandler(history_path, maxBytes=max_history_bytes,
+                                                           backupCount=history_backups, delay=True)
+            handler.setFormatter(logging.Formatter('%(asctime)s,%(message)s'))
+            self.history.addHandler(handler)
+
+    # Start or refresh the preemption for a signal; the file is only rewritten when the
+    # active set or its drivers change or the expiry has moved on by more than half a TTL
+    def preempt(self, signal_lat, signal_lon, driver_id=None, level='high', now=None):
+        now = time.time() if now is None else now
+        signal = (signal_lat, signal_lon)
+        with self.lock:
+            changed = self.expire_locked(now)
+            record = self.active.get(signal)
+            if record is None:
+                record = {'level': level, 'drivers': set(), 'expires_at': now + self.ttl, 'written_expiry': None}
+                self.active[signal] = record
+                self.history.info(f"start,\"{signal}\",{level},{driver_id}")
+                changed = True
+            record['expires_at'] = now + self.ttl
+            if driver_id is not None and driver_id not in record['drivers']:
+                record['drivers'].add(driver_id)
+                changed = True
+            if record['written_expiry'] is None or record['expires_at'] - record['written_expiry'] > self.ttl / 2:
+                changed = True
+            if changed or self.dirty:
+                self.write_locked()
+
+    # A driver left the signal's zone; the record is dropped once no driver holds it
+    def release(self, signal_lat, signal_lon, driver_id=None, now=None):
+        now = time.time() if now is None else now
+        signal = (signal_lat, signal_lon)
+        with self.lock:
+            changed = self.expire_locked(now)
+            record = self.active.get(signal)
+            if record is not None:
+                record['drivers'].discard(driver_id)
+                if not record['drivers']:
+                    del self.active[signal]
+                    self.history.info(f"release,\"{signal}\",{record['level']},{driver_id}")
+                    changed = True
+            if changed or self.dirty:
+                self.write_locked()
+
+    # Drop records whose TTL ran out (and retry a failed rewrite); call periodically
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.expire_locked(now) or self.dirty:
+                self.write_locked()
+
+    def expire_locked(self, now):
+        expired = [signal for signal, record in self.active.items() if record['expires_at'] <= now]
+        for signal in expired:
+            record = self.active.pop(signal)
+            self.history.info(f"expire,\"{signal}\",{record['level']},{';'.join(sorted(record['drivers']))}")
+        return bool(expired)
+
+    def active_set(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            return {signal: record['level'] for signal, record in self.active.items() if record['expires_at'] > now}
+
+    # Rewrite output.csv with the active set via a temp file so readers never see a partial file
+    def write_locked(self):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, mode='w', newline='') as file:
+            writer = csv.writer(file)
+            for signal, record in self.active.items():
+                writer.writerow([signal, record['level'], f"{record['expires_at']:.3f}",
+                                 ';'.join(sorted(record['drivers']))])
+        try:
+            os.replace(temp_path, self.path)
+        except PermissionError:
+            # A reader holds the file open (Windows); keep the set dirty and retry on the next write
+            os.remove(temp_path)
+            self.dirty = True
+            return
+        self.dirty = False
+        for record in self.active.values():
+            record['written_expiry'] = record['expires_at']
+
+
+# Consumer side: read the active preemptions from output.csv as {(lat, lon): level}.
+# Rows without an expiry (the old append-only format) or already expired are ignored.
+def read_active_preemptions(path='output.csv', now=None):
+    now = time.time() if now is None else now
+    active = {}
+    try:
+        with open(path, mode='r', newline='') as file:
+            for row in csv.reader(file):
+                if len(row) < 3:
+                    continue
+                match = re.match(r"\(([^,]+), ([^,]+)\)", row[0])
+                try:
+                    expires_at = float(row[2])
+                except ValueError:
+                    continue
+                if match and expires_at > now:
+                    active[(float(match.group(1)), float(match.group(2)))] = row[1]
+    except FileNotFoundError:
+        pass
+    return active
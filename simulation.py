@@ -0,0 +1,281 @@
+import asyncio
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+
+import numpy as np
+
+# Simulation settings; pass a JSON file with any of these keys to override them:
+#   python simulation.py my_config.json
+CONFIG = {
+    'detector': 'stub',  # 'stub' replaces cv2.dnn with StubNetwork, 'yolo' loads the real model
+    'weights': None,  # Model paths for the 'yolo' detector (default: the paths in TrafficSIgnalComputerVision)
+    'cfg': None,
+    'names': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'coco.names.txt'),
+    'stub_latency': 0.05,  # Seconds of simulated inference per image
+    'video_paths': [],  # Real videos to measure frames/sec on; synthetic frames are used when empty
+    'frames': 64,  # Synthetic frames pushed through the detector for the frames/sec figure
+    'frame_size': [720, 1280],
+    'batch_size': 4,
+    'hours': 2,  # Virtual time the intersection is run for
+    'arrival_rates': [0.25, 0.15],  # Vehicles per second arriving on each approach
+    'discharge_rate': 0.5,  # Vehicles per second leaving a queue while its light is green
+    'analysis_interval': 10,  # Seconds between detector snapshots
+    'ambulances': 12,
+    'ambulance_speed': [8, 22],  # m/s, drawn uniformly per ambulance
+    'ambulance_start_km': 4,
+    'signal': [9.921, 78.116],
+    'tracks_file': None,  # Recorded driver_id,t,lat,lon tracks instead of synthetic ambulances
+    'workdir': None,  # Directory for signal_coor.csv and the other CSVs (default: a temporary one)
+    'seed': 7,
+}
+
+from message_bus import MessageBus, PreemptionRequest
+
+# The detector is chosen when TrafficSIgnalComputerVision is imported, so it (and the modules that
+# import it) are only imported by load_modules(), once the config has set up the environment
+tscv = check = load_tracks = None
+
+
+def load_modules(config):
+    global tscv, check, load_tracks
+    os.environ['TRAFFIC_DETECTOR'] = config['detector']
+    for key, variable in (('weights', 'TRAFFIC_WEIGHTS'), ('cfg', 'TRAFFIC_CFG'), ('names', 'TRAFFIC_NAMES')):
+        if config[key]:
+            os.environ[variable] = os.path.abspath(config[key])
+    import TrafficSIgnalComputerVision as tscv
+    import check
+    from benchmark import load_tracks
+
+
+# Frames/sec of the detector, on the configured videos or on synthetic frames
+def measure_detection(config):
+    if config['video_paths']:
+        start = time.perf_counter()
+        results = tscv.process_videos_batched(config['video_paths'], 5, config['batch_size'], headless=True,
+                                              **tscv.SAMPLING_POLICY)
+        frames = sum(stats['frames_inferred'] for _, _, stats in results)
+        return frames, time.perf_counter() - start
+
+    frame = np.zeros(tuple(config['frame_size']) + (3,), dtype=np.uint8)
+    batch = [frame] * config['batch_size']
+    frames = 0
+    start = time.perf_counter()
+    while frames < config['frames']:
+        tscv.detect_objects_batch(batch, draw=False)
+        frames += len(batch)
+    return frames, time.perf_counter() - start
+
+
+# Move a point `north` and `east` meters away from (lat, lon)
+def offset_position(lat, lon, north, east):
+    return (lat + math.degrees(north / 6371000),
+            lon + math.degrees(east / (6371000 * math.cos(math.radians(lat)))))
+
+
+# Ambulances driving straight through the signal along one of the approach axes, in either
+# direction, with one GPS fix (with ~5 m noise) per second. Returns driver_id -> [(t, lat, lon)].
+def make_ambulance_tracks(config, rng):
+    signal = config['signal']
+    start_distance = config['ambulance_start_km'] * 1000
+    span = config['hours'] * 3600 - 2 * start_distance / config['ambulance_speed'][0]
+    tracks = {}
+    for n in range(config['ambulances']):
+        start = (n + rng.uniform(0, 1)) * span / config['ambulances']
+        speed = rng.uniform(*config['ambulance_speed'])
+        heading = math.radians(tscv.APPROACH_HEADINGS[n % len(tscv.APPROACH_HEADINGS)] + 180 * (n // 2 % 2))
+        fixes = []
+        for t in range(int(2 * start_distance / speed)):
+            along = -start_distance + speed * t
+            fixes.append((start + t,) + offset_position(signal[0], signal[1],
+                                                         along * math.cos(heading) + rng.normal(0, 5),
+                                                         along * math.sin(heading) + rng.normal(0, 5)))
+        tracks[f"AMB{n}"] = fixes
+    return tracks
+
+
+# Approach whose axis is most nearly parallel to a direction of travel; the ground truth the
+# controller's approach_for_heading is checked against
+def serving_approach(heading):
+    return max(range(len(tscv.APPROACH_HEADINGS)),
+               key=lambda i: abs(math.cos(math.radians(heading - tscv.APPROACH_HEADINGS[i]))))
+
+
+# How long `approach` had been green when a vehicle crossed at `when` (consecutive phases for
+# the same approach count as one green), from a controller's phase history; None if it was red
+def green_lead(phase_history, when, approach):
+    green_since = None
+    for start, phase_approach, _, _ in phase_history:
+        if start > when:
+            break
+        if phase_approach != approach:
+            green_since = None
+        elif green_since is None:
+            green_since = start
+    return None if green_since is None else when - green_since
+
+
+def mean(values):
+    return sum(values) / len(values) if values else 0.0
+
+
+# Run one intersection on a VirtualClock: Poisson traffic queues up on each approach and drains
+# while its light is green, a detector snapshot of each queue and the discharge rate seen over the
+# last analysis interval size the green durations, and ambulance fixes
+# go through check.ProximityTracker and the message bus to the controller
+async def simulate(config, tracks, inference_seconds, rng):
+    clock = tscv.VirtualClock()
+    approaches = len(tscv.APPROACH_HEADINGS)
+    queues = [deque() for _ in range(approaches)]
+    waits = []
+    snapshot = {'queues': [(0, 0.0)] * approaches, 'captured_at': 0.0}
+    discharge = tscv.DischargeEstimator()
+    # Vehicles discharged and seconds of green per approach since the last snapshot
+    departed = [0] * approaches
+    green_seconds = [0] * approaches
+    decision_latencies = []
+    frame = np.zeros(tuple(config['frame_size']) + (3,), dtype=np.uint8)
+
+    def durations_source():
+        decision_latencies.append(clock.time() - snapshot['captured_at'])
+        return tscv.queue_green_durations(snapshot['queues'])
+
+    controller = tscv.IntersectionController("Simulated intersection", durations_source, clock,
+                                             log=lambda message: None, signal=tuple(config['signal']))
+
+    async def traffic():
+        credit = 0.0
+        while True:
+            now = clock.time()
+            for approach, rate in enumerate(config['arrival_rates'][:approaches]):
+                queues[approach].extend([now] * rng.poisson(rate))
+            if controller.green_approach is not None:
+                credit += config['discharge_rate']
+                queue = queues[controller.green_approach]
+                if queue:
+                    green_seconds[controller.green_approach] += 1
+                while credit >= 1 and queue:
+                    credit -= 1
+                    departed[controller.green_approach] += 1
+                    waits.append(now - queue.popleft())
+                credit = min(credit, 1.0)
+            await clock.sleep(1)
+
+    # Frames are captured, then the queue lengths become available once inference would have
+    # finished. The discharge rate is vehicles per second of green with a queue waiting, 0 (keep
+    # the previous estimate) for an approach that had none.
+    async def analyzer():
+        while True:
+            captured_at = clock.time()
+            measured = []
+            for approach, queue in enumerate(queues):
+                if isinstance(tscv.detector.net, tscv.StubNetwork):
+                    tscv.detector.net.vehicles = len(queue)
+                    queue_length = sum(tscv.detect_objects(frame, draw=False))
+                else:  # A real model sees nothing in synthetic frames, so use the true queue
+                    tscv.detect_objects(frame, draw=False)
+                    queue_length = len(queue)
+                rate = departed[approach] / green_seconds[approach] if green_seconds[approach] else 0.0
+                measured.append((queue_length, discharge.observe(approach, rate)))
+                departed[approach] = green_seconds[approach] = 0
+            await clock.sleep(inference_seconds * approaches)
+            snapshot.update(queues=measured, captured_at=captured_at)
+            await clock.sleep(max(0, config['analysis_interval'] - inference_seconds * approaches))
+
+    bus = MessageBus()
+    tscv.connect_controller_to_bus(bus, controller, asyncio.get_running_loop())
+    first_request = {}
+    bus.subscribe(PreemptionRequest, lambda message: first_request.setdefault(message.driver_id, clock.time()))
+
+    signals_file = os.path.abspath('signal_coor.csv')
+    ignore = lambda *args: None
+    tracker = check.ProximityTracker('coordinates.csv', signals_file, on_enter=ignore, on_exit=ignore,
+                                     on_predict=ignore, on_stay=ignore, bus=bus,
+                                     predictor=check.EtaPredictor(signals_file))
+    for driver_id, fixes in tracks.items():
+        for t, lat, lon in fixes:
+            clock.call_at(t, lambda d=driver_id, t=t, lat=lat, lon=lon: tracker.apply_positions([(d, lat, lon)], t))
+
+    helpers = [asyncio.ensure_future(traffic()), asyncio.ensure_future(analyzer())]
+    try:
+        await tscv.run_intersections([controller], clock, config['hours'] * 3600)
+    finally:
+        for task in helpers:
+            task.cancel()
+        await asyncio.gather(*helpers, return_exceptions=True)
+
+    # Green lead: how long before each ambulance actually crossed (its fix closest to the signal)
+    # its approach had turned green; ambulances that crossed on red have none
+    green_leads = []
+    signal = config['signal']
+    for driver_id, fixes in tracks.items():
+        distances = [check.haversine(lat, lon, *signal) for _, lat, lon in fixes]
+        closest = int(np.argmin(distances))
+        heading = check.bearing_deg(*fixes[max(closest - 5, 0)][1:], *fixes[min(closest + 5, len(fixes) - 1)][1:])
+        lead = green_lead(controller.phase_history, fixes[closest][0], serving_approach(heading))
+        if lead is not None:
+            green_leads.append(lead)
+
+    return {
+        'waits': waits,
+        'queued': sum(len(queue) for queue in queues),
+        'decision_latencies': decision_latencies,
+        'green_leads': green_leads,
+        'requested': len(first_request),
+        'crossed_on_green': len(green_leads),
+        'phases': len(controller.phase_history),
+    }
+
+
+def main(config=CONFIG):
+    load_modules(config)
+    rng = np.random.default_rng(config['seed'])
+    if isinstance(tscv.detector.net, tscv.StubNetwork):
+        tscv.detector.net.latency = config['stub_latency']
+        tscv.detector.net.vehicles = 10
+
+    frames, elapsed = measure_detection(config)
+    inference_seconds = elapsed / frames if frames else 0.0
+    print(f"Detector ({config['detector']}): {frames} frames in {elapsed:.2f} s, {frames / elapsed:.1f} frames/sec")
+    if isinstance(tscv.detector.net, tscv.StubNetwork):
+        tscv.detector.net.latency = 0.0  # Inference time is charged to the virtual clock from here on
+
+    workdir = tempfile.TemporaryDirectory() if config['workdir'] is None else None
+    tracks_file = os.path.abspath(config['tracks_file']) if config['tracks_file'] else None
+    previous_directory = os.getcwd()
+    os.chdir(workdir.name if workdir else config['workdir'])
+    try:
+        with open('signal_coor.csv', mode='w') as file:
+            file.write(f"{config['signal'][0]},{config['signal'][1]}\n")
+        tracks = load_tracks(tracks_file) if tracks_file else make_ambulance_tracks(config, rng)
+
+        start = time.perf_counter()
+        results = asyncio.run(simulate(config, tracks, inference_seconds, rng))
+        wall = time.perf_counter() - start
+    finally:
+        os.chdir(previous_directory)
+        if workdir:
+            workdir.cleanup()
+
+    print(f"Simulated {config['hours']}h of signal operation in {wall:.2f} s wall time, {results['phases']} phases")
+    print(f"  average vehicle wait: {mean(results['waits']):.1f} s over {len(results['waits'])} vehicles "
+          f"({results['queued']} still queued)")
+    print(f"  detection-to-decision latency: mean {mean(results['decision_latencies']):.1f} s, "
+          f"max {max(results['decision_latencies'], default=0):.1f} s")
+    print(f"  green lead before crossing: mean {mean(results['green_leads']):.1f} s, "
+          f"min {min(results['green_leads'], default=0):.1f} s "
+          f"({results['requested']}/{len(tracks)} ambulances requested preemption)")
+    print(f"  ambulances crossing on green: {results['crossed_on_green']}/{len(tracks)}")
+    return results
+
+
+if __name__ == "__main__":
+    config = dict(CONFIG)
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], mode='r') as file:
+            config.update(json.load(file))
+    main(config)